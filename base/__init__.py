@@ -4,7 +4,15 @@ import os
 import uweb3
 
 # Application
+from . import export
 from . import pages
+from . import pool
+
+
+class Warehouse(pool.PoolMixin, export.StreamingMixin, uweb3.uWeb):
+  """The uWeb3 application, able to stream exports, that hands the database
+  connection of every request back to the worker's pool."""
+
 
 def main():
   """Creates a uWeb3 application.
@@ -15,8 +23,12 @@ def main():
   - The routes iterable, where each 2-tuple defines a url-pattern and the
     name of a presenter method which should handle it.
   - The execution path, internally used to find templates etc.
+
+  The templates are parsed up front, so with gunicorn's preload_app they are
+  shared by all forked workers.
   """
-  return uweb3.uWeb(pages.PageMaker,
+  pages.Preload()
+  return Warehouse(pages.PageMaker,
       [
 
        ('/', 'RequestProductNew', 'POST'),
@@ -45,6 +57,7 @@ def main():
        ('/supplier/([^/]*)', 'RequestSupplier', 'GET'),
        ('/supplier/([^/]*)/remove', 'RequestSupplierRemove', 'POST'),
 
+       (r'/product/([^/]*)/stock\.(csv|ndjson)', 'RequestProductStockExport', 'GET'),
        ('/product/([^/]*)', 'RequestProductSave', 'POST'),
        ('/product/([^/]*)', 'RequestProduct', 'GET'),
        ('/product/([^/]*)/remove', 'RequestProductRemove', 'POST'),
@@ -52,8 +65,17 @@ def main():
        ('/product/([^/]*)/assembly', 'RequestProductAssemblySave', 'POST'),
        ('/product/([^/]*)/stock', 'RequestProductStock', 'POST'),
 
+       (r'/stock\.(csv|ndjson)', 'RequestStockExport', 'GET'),
+
+       ('/api/v1/products', 'JsonProducts'),
        ('/api/v1/product/([^/]*)', 'JsonProduct', 'GET'),
        ('/api/v1/product/([^/]*)/stock', 'JsonProductStock', 'POST'),
+       ('/api/v1/stock/batch', 'JsonStockBatch', 'POST'),
+       ('/api/v1/import', 'JsonImport', 'POST'),
+
+       ('/import', 'RequestImport'),
+
+       ('/metrics', 'RequestMetrics'),
 
        # Helper files
        ('(/styles/.*)', 'Static'),
@@ -0,0 +1,213 @@
+#!/usr/bin/python3
+"""In-process caches for the warehouse.
+
+The caches live in the memory of a single worker process. Entries expire after
+their time to live, and the caches are bounded in size by discarding the least
+recently used entries.
+"""
+
+# standard modules
+import collections
+import os
+import threading
+import time
+
+
+class TTLCache:
+  """A bounded, thread safe cache whose entries expire after a time to live."""
+  def __init__(self, maxsize=1024, ttl=60):
+    """Sets up the cache.
+
+    Arguments:
+      % maxsize: int ~~ 1024
+        The maximum amount of entries, the least recently used entries are
+        discarded beyond this.
+      % ttl: int ~~ 60
+        Default amount of seconds an entry stays valid.
+    """
+    self.maxsize = maxsize
+    self.ttl = ttl
+    self.generation = 0
+    self._entries = collections.OrderedDict()
+    self._lock = threading.Lock()
+
+  def Get(self, key, default=None):
+    """Returns the cached value for the key, or the default when it is not
+    cached or has expired."""
+    with self._lock:
+      try:
+        expires, value = self._entries[key]
+      except KeyError:
+        return default
+      if expires < time.monotonic():
+        del self._entries[key]
+        return default
+      self._entries.move_to_end(key)
+      return value
+
+  def Set(self, key, value, ttl=None, generation=None):
+    """Caches the value for the key.
+
+    When a generation is given, the value is only cached if nothing was
+    invalidated since that generation was read. This keeps a value that was
+    loaded before an invalidation from being cached after it.
+    """
+    expires = time.monotonic() + (self.ttl if ttl is None else ttl)
+    with self._lock:
+      if generation is not None and generation != self.generation:
+        return
+      self._entries[key] = expires, value
+      self._entries.move_to_end(key)
+      while len(self._entries) > self.maxsize:
+        self._entries.popitem(last=False)
+
+  def Delete(self, key):
+    """Removes the key from the cache, if present."""
+    with self._lock:
+      self._entries.pop(key, None)
+
+  def Invalidate(self, key):
+    """Removes the key from the cache and starts a new generation, so values
+    loaded before this point are not cached anymore."""
+    with self._lock:
+      self.generation += 1
+      self._entries.pop(key, None)
+
+  def Clear(self):
+    """Removes all entries from the cache."""
+    with self._lock:
+      self._entries.clear()
+
+  def __len__(self):
+    return len(self._entries)
+
+
+class CountCache:
+  """Caches the total result counts of model listings.
+
+  Counts are stored per table and listing arguments. Invalidating a table
+  discards all of its cached counts at once. Changes made by other workers are
+  picked up by passing a version read from the database along, counts cached
+  for another version are not used.
+  """
+  def __init__(self, maxsize=1024, ttl=300):
+    self.cache = TTLCache(maxsize, ttl)
+    self.generations = collections.defaultdict(int)
+
+  def _Key(self, table, arguments, version, generation=None):
+    if generation is None:
+      generation = self.generations[table]
+    return table, generation, version, arguments
+
+  def Generation(self, table):
+    """Returns the current generation of the table's counts, to be read before
+    counting and passed to Set."""
+    return self.generations[table]
+
+  def Get(self, table, arguments, version=None):
+    """Returns the cached count for the listing, or None."""
+    return self.cache.Get(self._Key(table, arguments, version))
+
+  def Set(self, table, arguments, count, version=None, generation=None):
+    """Caches the count for the listing.
+
+    When a generation is given, the count is cached under that generation, so
+    a count made before the table was invalidated is never used after it."""
+    self.cache.Set(self._Key(table, arguments, version, generation), count)
+
+  def Invalidate(self, table):
+    """Discards all cached counts for the given table."""
+    self.generations[table] += 1
+
+
+class PageCache:
+  """Caches rendered pages, bounded by their total size.
+
+  The least recently used pages are discarded once the pages together hold
+  more than the maximum amount of characters, and pages expire after their
+  time to live. Lookups are counted per handler as hits and misses.
+  """
+  def __init__(self, maxsize=16 * 1024 * 1024, ttl=300):
+    """Sets up the cache.
+
+    Arguments:
+      % maxsize: int ~~ 16 MiB
+        The maximum amount of characters held by all cached pages together.
+      % ttl: int ~~ 300
+        Amount of seconds a page stays valid, bounding how long a page can
+        be stale when an invalidation was missed.
+    """
+    self.maxsize = maxsize
+    self.ttl = ttl
+    self.size = 0
+    self.generation = 0
+    self.hits = collections.Counter()
+    self.misses = collections.Counter()
+    self._entries = collections.OrderedDict()
+    self._lock = threading.Lock()
+
+  def Get(self, handler, key):
+    """Returns the cached page of the handler for the key, or None."""
+    with self._lock:
+      entry = self._entries.get((handler, key))
+      if entry is not None and entry[0] < time.monotonic():
+        del self._entries[handler, key]
+        self.size -= len(entry[1])
+        entry = None
+      if entry is None:
+        self.misses[handler] += 1
+        return None
+      self._entries.move_to_end((handler, key))
+      self.hits[handler] += 1
+      return entry[1]
+
+  def Set(self, handler, key, page, generation):
+    """Caches the page, unless the cache was invalidated since the given
+    generation was read, as the page might then show stale data."""
+    if len(page) > self.maxsize:
+      return
+    with self._lock:
+      if generation != self.generation:
+        return
+      old = self._entries.pop((handler, key), None)
+      if old is not None:
+        self.size -= len(old[1])
+      self._entries[handler, key] = time.monotonic() + self.ttl, page
+      self.size += len(page)
+      while self.size > self.maxsize:
+        _key, (_expires, old) = self._entries.popitem(last=False)
+        self.size -= len(old)
+
+  def Invalidate(self):
+    """Discards all cached pages, and starts a new generation."""
+    with self._lock:
+      self.generation += 1
+      self._entries.clear()
+      self.size = 0
+
+  def Render(self):
+    """Returns the hit and miss counts and the cache size in the Prometheus
+    text format, labelled with the process ID of the worker."""
+    lines = []
+    worker = os.getpid()
+    with self._lock:
+      for name, counts, description in (
+          ('warehouse_page_cache_hits_total', self.hits,
+           'Pages served from the rendered page cache.'),
+          ('warehouse_page_cache_misses_total', self.misses,
+           'Pages rendered because they were not cached.')):
+        lines.append('# HELP %s %s' % (name, description))
+        lines.append('# TYPE %s counter' % name)
+        for handler in sorted(counts):
+          lines.append('%s{handler="%s",worker="%d"} %d' % (
+              name, handler, worker, counts[handler]))
+      lines.append('# HELP warehouse_page_cache_size Characters held by the '
+                   'rendered page cache.')
+      lines.append('# TYPE warehouse_page_cache_size gauge')
+      lines.append('warehouse_page_cache_size{worker="%d"} %d' % (
+          worker, self.size))
+    return '\n'.join(lines) + '\n'
+
+
+COUNTS = CountCache()
+PAGES = PageCache()
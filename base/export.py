@@ -0,0 +1,97 @@
+#!/usr/bin/python3
+"""Streaming exports of large result sets.
+
+uWeb3 builds the complete body of a response before sending it. An export
+instead registers a generator for its body, which the StreamingMixin sends to
+the client chunk by chunk, so memory use does not grow with the export.
+"""
+
+# standard modules
+import csv
+import io
+import json
+import threading
+
+FORMATS = {'csv': 'text/csv; charset=utf-8',
+           'ndjson': 'application/x-ndjson; charset=utf-8'}
+# Amount of rows encoded together into a single chunk of the body.
+CHUNKROWS = 500
+
+_STREAM = threading.local()
+
+
+def Csv(rows, fields):
+  """Yields the rows as CSV, starting with a header line."""
+  buffer = io.StringIO()
+  writer = csv.DictWriter(buffer, fields, extrasaction='ignore')
+  writer.writeheader()
+  for count, row in enumerate(rows, 1):
+    writer.writerow(row)
+    if count % CHUNKROWS == 0:
+      yield buffer.getvalue().encode('utf8')
+      buffer.seek(0)
+      buffer.truncate()
+  yield buffer.getvalue().encode('utf8')
+
+
+def Ndjson(rows):
+  """Yields the rows as newline delimited JSON, one object per line."""
+  chunk = []
+  for row in rows:
+    chunk.append(json.dumps(row, default=str))
+    if len(chunk) == CHUNKROWS:
+      yield ('\n'.join(chunk) + '\n').encode('utf8')
+      chunk = []
+  if chunk:
+    yield ('\n'.join(chunk) + '\n').encode('utf8')
+
+
+def Stream(rows, fileformat, fields):
+  """Registers the rows as the body of the current response.
+
+  Arguments:
+    @ rows: iterable of dict
+      The rows to export, generated as they are sent.
+    @ fileformat: str
+      Either 'csv' or 'ndjson'.
+    @ fields: tuple of str
+      The fields to export, in order.
+
+  Returns:
+    str: the content type of the export.
+  """
+  if fileformat == 'csv':
+    _STREAM.body = Csv(rows, fields)
+  else:
+    _STREAM.body = Ndjson(
+        {field: row[field] for field in fields} for row in rows)
+  return FORMATS[fileformat]
+
+
+class StreamingMixin:
+  """Sends the body registered through Stream in place of the built body."""
+  def __call__(self, environ, start_response):
+    _STREAM.body = None
+    response = {}
+    written = []
+
+    def capture(status, headers, exc_info=None):
+      response.update(status=status, headers=headers, exc_info=exc_info)
+      return written.append
+
+    result = super().__call__(environ, capture)
+    try:
+      content = written + list(result)
+    finally:
+      if hasattr(result, 'close'):
+        result.close()
+    body, _STREAM.body = _STREAM.body, None
+    if body is None or not response['status'].startswith('200'):
+      start_response(response['status'], response['headers'],
+                     response['exc_info'])
+      return content
+    start_response(response['status'],
+                   [(name, value) for name, value in response['headers']
+                    if name.lower() != 'content-length'],
+                   response['exc_info'])
+    return body
@@ -3,6 +3,9 @@
 __author__ = 'Jan Klopper (jan@underdark.nl)'
 __version__ = 0.1
 
+import base64
+import binascii
+import json
 import math
 
 class SortTable:
@@ -27,13 +30,18 @@ class SortTable:
     return iter(self.items)
 
 class PagedResult:
+  keyset = False
+
   def __init__(self,
                pagesize,
                page,
                modelCall,
                connection=None,
                modelargs=None,
-               maxlinks=10):
+               maxlinks=10,
+               prefetch=None,
+               counts=None,
+               countversion=None):
     """Returns a dictionary with pagination information based on parameters.
 
     Takes:
@@ -42,6 +50,12 @@ class PagedResult:
       modelCall: Function object for calling the model, function
       connection: An optional database connection object, object
       modelargs: An optional model call argument dictionary, dict
+      prefetch: Optional foreign fields the model loads for the whole page at
+                once, list
+      counts: Optional CountCache, when the total count for this listing is
+              cached no count query is done, CountCache
+      countversion: Optional version of the data the count is cached for, a
+                    count cached for another version is not used
 
    Creates the following members:
       pagesize: The pagesize variable given as a parameter, int
@@ -60,15 +74,31 @@ class PagedResult:
     except:
       self.current = 0
 
+    countkey = itemcount = None
+    if counts is not None:
+      table = modelCall.__self__.TableName()
+      countkey = modelCall.__name__, repr(sorted(
+          (key, value) for key, value in modelargs.items()
+          if key not in ('offset', 'limit', 'order', 'prefetch',
+                         'yield_unlimited_total_first')))
+      generation = counts.Generation(table)
+      itemcount = counts.Get(table, countkey, countversion)
+
     self.offset = modelargs['offset'] = self.pagesize * (self.current - 1)
-    modelargs['yield_unlimited_total_first'] = True
+    modelargs['yield_unlimited_total_first'] = itemcount is None
     modelargs['limit'] = self.pagesize
+    if prefetch:
+      modelargs['prefetch'] = prefetch
     if (connection and type(modelCall.__self__) is type):  # is this in unbound method?, ifso it needs a connection argument
       items = list(modelCall(connection, **modelargs))
     else:  # is a bound method of a model object that already has a connection reference
       items = list(modelCall(**modelargs))
-    self.totalcount = itemcount = items[0]
-    self.items = items[1:]
+    if itemcount is None:
+      itemcount = items.pop(0)
+      if countkey is not None:
+        counts.Set(table, countkey, itemcount, countversion, generation)
+    self.totalcount = itemcount
+    self.items = items
     self.last = self.pagecount = int(math.ceil(float(itemcount) / self.pagesize))
 
     pagenumbers = []
@@ -87,3 +117,133 @@ class PagedResult:
 
   def __iter__(self):
     return iter(self.items)
+
+
+class KeysetResult:
+  """Paginates a model listing by seeking past the sort key of the last item.
+
+  Unlike PagedResult, which uses an offset and always counts the full result
+  set, every page is fetched with an indexed range condition on the sort key
+  of the current ordering, so a deep page costs the same as the first one.
+  Items with equal sort keys are ordered by their primary key.
+  """
+  keyset = True
+
+  def __init__(self,
+               pagesize,
+               modelCall,
+               connection,
+               modelargs=None,
+               after=None,
+               before=None,
+               count=False,
+               prefetch=None,
+               primary='ID'):
+    """Fetches a single page of items.
+
+    Takes:
+      pagesize: Number specifying the amount of items per page, int
+      modelCall: Function object for calling the model, function
+      connection: The database connection object, object
+      modelargs: An optional model call argument dictionary, the first field
+                 of its `order` is used as sort key, dict
+      after: Cursor of the item after which this page starts, str
+      before: Cursor of the item before which this page ends, str
+      count: Also count the total amount of items, bool
+      prefetch: Optional foreign fields the model loads for the whole page at
+                once, list
+      primary: The primary key field used to order items with equal sort
+               keys, str
+
+    Creates the following members:
+      pagesize: The pagesize variable given as a parameter, int
+      items: The items on this page, list
+      totalcount: The total item count when requested, else None, int
+      next: Cursor for the next page, if there is one, str
+      prev: Cursor for the previous page, if there is one, str
+    """
+    modelargs = {} if modelargs is None else dict(modelargs)
+    self.pagesize = int(pagesize)
+    self.primary = primary
+    sortkey, descending = (modelargs.get('order') or [(primary, False)])[0]
+    self.sortkey = sortkey
+    after = self.DecodeCursor(after)
+    before = None if after else self.DecodeCursor(before)
+
+    # When seeking backwards the order is reversed, and so is the page.
+    reverse = before is not None
+    seekdescending = descending != reverse
+    conditions = list(modelargs.get('conditions', []))
+    if after or before:
+      conditions.append(self._Beyond(connection, after or before, seekdescending))
+    modelargs['conditions'] = conditions
+    modelargs['order'] = [(sortkey, seekdescending)]
+    if sortkey != primary:
+      modelargs['order'].append((primary, seekdescending))
+    modelargs['limit'] = self.pagesize + 1
+    modelargs['yield_unlimited_total_first'] = count
+    if prefetch:
+      modelargs['prefetch'] = prefetch
+    if type(modelCall.__self__) is type:  # is this in unbound method?, ifso it needs a connection argument
+      items = list(modelCall(connection, **modelargs))
+    else:  # is a bound method of a model object that already has a connection reference
+      items = list(modelCall(**modelargs))
+    self.totalcount = items.pop(0) if count else None
+
+    more = len(items) > self.pagesize
+    self.items = items[:self.pagesize]
+    if reverse:
+      self.items.reverse()
+    self.next = self.prev = None
+    if self.items:
+      if more or reverse:
+        self.next = self.Cursor(self.items[-1])
+      if after or (reverse and more):
+        self.prev = self.Cursor(self.items[0])
+
+  def Cursor(self, item):
+    """Returns the opaque cursor pointing at the given item."""
+    value = [item[self.primary]]
+    if self.sortkey != self.primary:
+      value.insert(0, item.get(self.sortkey))
+    return base64.urlsafe_b64encode(json.dumps(value).encode()).decode()
+
+  def DecodeCursor(self, cursor):
+    """Returns the sort values stored in a cursor, or None when invalid."""
+    if not cursor:
+      return None
+    try:
+      value = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+    except (binascii.Error, ValueError, UnicodeError):
+      return None
+    if (not isinstance(value, list) or
+        len(value) != (1 if self.sortkey == self.primary else 2)):
+      return None
+    return value
+
+  def _Beyond(self, connection, cursor, descending):
+    """Returns the condition for items that follow the cursor in the order.
+
+    MySQL sorts NULL values first, so NULL sort keys are the lowest values.
+    """
+    key = self.sortkey
+    if key == self.primary:
+      return '`%s` %s %s' % (key, '<' if descending else '>',
+                             connection.EscapeValues(cursor[0]))
+    value, primary = cursor
+    primary = connection.EscapeValues(primary)
+    compare = '<' if descending else '>'
+    if value is None:
+      if descending:
+        return '(`%s` IS NULL AND `%s` < %s)' % (key, self.primary, primary)
+      return '(`%s` IS NOT NULL OR `%s` %s %s)' % (
+          key, self.primary, compare, primary)
+    value = connection.EscapeValues(value)
+    beyond = '`%s` %s %s OR (`%s` = %s AND `%s` %s %s)' % (
+        key, compare, value, key, value, self.primary, compare, primary)
+    if descending:
+      beyond += ' OR `%s` IS NULL' % key
+    return '(%s)' % beyond
+
+  def __iter__(self):
+    return iter(self.items)
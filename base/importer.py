@@ -0,0 +1,318 @@
+#!/usr/bin/python3
+"""Bulk import of products, bills of materials and opening stock.
+
+Rows are read from a CSV, JSON or newline delimited JSON file. The `type` of a
+row decides what it creates:
+
+  product: a product (the default), from its name, ean, gs1, sku, description,
+           supplier (name or ID), cost, assemblycosts and vat.
+  part:    a part in the bill of materials of a product, from the product and
+           part names, the amount and the assemblycosts.
+  stock:   a stock mutation, from the product name, amount, reference and lot.
+
+Rows are processed in chunks. The rows of a chunk are validated and their
+names normalized together, the products they refer to are looked up with a
+single query, and every kind of row is written with a multi-row INSERT in a
+transaction per chunk. Rows that cannot be imported are reported with their
+line number without stopping the import. Products need to be listed before the
+parts and stock that refer to them.
+"""
+
+# standard modules
+import csv
+import json
+import math
+
+# Application
+from . import cache
+from . import model
+
+FORMATS = 'csv', 'json', 'ndjson'
+CHUNKSIZE = 1000
+# Errors beyond this amount are counted, but not reported individually.
+MAXERRORS = 1000
+DEFAULTSUPPLIER = 1
+DEFAULTVAT = 21
+# Largest stock mutation, the range of the signed mediumint amount column, and
+# the most bytes a product description (a text column) holds.
+MAXSTOCKAMOUNT = 2 ** 23 - 1
+MAXDESCRIPTION = 65535
+
+
+class RowError(ValueError):
+  """A row cannot be imported."""
+
+
+def ReadRows(stream, fileformat):
+  """Yields the line number and fields of every row in the file.
+
+  For JSON files holding a single array, the position of the row in the array
+  is used as its line number. Lines that cannot be decoded are yielded as a
+  RowError, so they are reported like any other invalid row.
+
+  Arguments:
+    @ stream: file
+      The file to import, opened in text mode.
+    @ fileformat: str
+      One of FORMATS.
+  """
+  if fileformat == 'csv':
+    reader = csv.DictReader(stream)
+    for row in reader:
+      yield reader.line_num, row
+  elif fileformat == 'ndjson':
+    for line, text in enumerate(stream, 1):
+      if not text.strip():
+        continue
+      try:
+        yield line, json.loads(text)
+      except ValueError as error:
+        yield line, RowError('Invalid JSON: %s' % error)
+  elif fileformat == 'json':
+    rows = json.load(stream)
+    if not isinstance(rows, list):
+      raise ValueError('A JSON import should hold an array of rows.')
+    yield from enumerate(rows, 1)
+  else:
+    raise ValueError('Unknown import format %r.' % fileformat)
+
+
+def _Text(row, field, length=None):
+  """Returns the stripped text of the field, or None when empty."""
+  value = row.get(field)
+  value = '' if value is None else str(value).strip()
+  return value[:length] or None
+
+
+def _Number(row, field, kind, default, maximum=None):
+  """Returns the field as the given kind of number, or the default when
+  empty."""
+  value = _Text(row, field)
+  if value is None:
+    return default
+  try:
+    value = kind(value)
+  except ValueError:
+    raise RowError('The %s should be a number.' % field)
+  if not math.isfinite(value):
+    raise RowError('The %s should be a number.' % field)
+  if value < 0 or (maximum is not None and value > maximum):
+    raise RowError('The %s is out of range.' % field)
+  return value
+
+
+def _Name(row, field, length=255):
+  """Returns the normalized common name in the field."""
+  name = model.NormalizeName(_Text(row, field) or '', length)
+  if not name:
+    raise RowError('Provide a valid %s.' % (
+        'name' if field == 'name' else '%s name' % field))
+  return name
+
+
+class Importer:
+  """Imports rows into the warehouse, collecting a report on the way."""
+  def __init__(self, connection, chunksize=CHUNKSIZE):
+    """Sets up the import.
+
+    Arguments:
+      @ connection: sqltalk.connection
+        Database connection to use.
+      % chunksize: int ~~ 1000
+        Amount of rows written per transaction.
+    """
+    self.connection = connection
+    self.chunksize = chunksize
+    self.created = {'product': 0, 'part': 0, 'stock': 0}
+    self.errors = []
+    self.errorcount = 0
+    self.products = {}
+    self.suppliers = None
+
+  def Import(self, rows):
+    """Imports the given rows and returns the report.
+
+    Arguments:
+      @ rows: iterable of (int, dict)
+        The line number and fields of every row, as yielded by ReadRows.
+
+    Returns:
+      dict: the amount of created products, parts and stock mutations, the
+            amount of rows that failed, and the errors of those rows.
+    """
+    chunk = []
+    for row in rows:
+      chunk.append(row)
+      if len(chunk) == self.chunksize:
+        self._Chunk(chunk)
+        chunk = []
+    if chunk:
+      self._Chunk(chunk)
+    return {'created': self.created,
+            'errorcount': self.errorcount,
+            'errors': sorted(self.errors, key=lambda error: error['line'])}
+
+  def _Error(self, line, error):
+    self.errorcount += 1
+    if len(self.errors) < MAXERRORS:
+      self.errors.append({'line': line, 'error': str(error)})
+
+  def _Chunk(self, chunk):
+    """Validates a chunk of rows, then writes it per kind."""
+    parsers = {'product': self._ProductValues,
+               'part': self._PartValues,
+               'stock': self._StockValues}
+    kinds = {kind: [] for kind in parsers}
+    for line, row in chunk:
+      try:
+        if isinstance(row, RowError):
+          raise row
+        if not isinstance(row, dict):
+          raise RowError('Rows should be objects.')
+        kind = (_Text(row, 'type') or 'product').lower()
+        if kind not in parsers:
+          raise RowError('Unknown row type %r.' % kind)
+        kinds[kind].append((line, parsers[kind](row)))
+      except RowError as error:
+        self._Error(line, error)
+    self._Products(kinds['product'])
+    self._Lookup({values[field] for kind in ('part', 'stock')
+                  for _line, values in kinds[kind]
+                  for field in ('product', 'part') if field in values})
+    self._Write('part', self._Resolve(kinds['part'], ('product', 'part')),
+                model.Productpart.CreateMany)
+    self._Write('stock', self._Resolve(kinds['stock'], ('product',)),
+                model.Stock.CreateMany)
+
+  def _Supplier(self, row):
+    """Returns the supplier ID for the supplier name or ID in the row."""
+    if self.suppliers is None:
+      self.suppliers = {}
+      for supplier in model.Supplier.List(self.connection):
+        self.suppliers[supplier['name']] = self.suppliers[
+            str(supplier['ID'])] = int(supplier['ID'])
+    supplier = _Text(row, 'supplier')
+    if supplier is None:
+      return DEFAULTSUPPLIER
+    if supplier not in self.suppliers:
+      supplier = model.NormalizeName(supplier, 45)
+    if supplier not in self.suppliers:
+      raise RowError('There is no supplier %r.' % _Text(row, 'supplier'))
+    return self.suppliers[supplier]
+
+  def _ProductValues(self, row):
+    ean = _Text(row, 'ean')
+    if ean is not None and (not ean.isdigit() or len(ean) > 13):
+      raise RowError('The ean should be at most 13 digits.')
+    description = _Text(row, 'description') or ''
+    if len(description.encode('utf8')) > MAXDESCRIPTION:
+      raise RowError('The description is too long.')
+    return {'name': _Name(row, 'name'),
+            'ean': ean,
+            'gs1': _Number(row, 'gs1', int, None, 65535),
+            'sku': _Text(row, 'sku', 45),
+            'description': description,
+            'supplier': self._Supplier(row),
+            'cost': _Number(row, 'cost', float, None, 999.999),
+            'assemblycosts': _Number(row, 'assemblycosts', float, 0, 99.999),
+            'vat': _Number(row, 'vat', float, DEFAULTVAT, 99.99)}
+
+  def _PartValues(self, row):
+    values = {'product': _Name(row, 'product'),
+              'part': _Name(row, 'part'),
+              'amount': _Number(row, 'amount', int, 1, 65535),
+              'assemblycosts': _Number(row, 'assemblycosts', float, 0, 99.999)}
+    if values['product'] == values['part']:
+      raise RowError('A product cannot be a part of itself.')
+    if not values['amount']:
+      raise RowError('The amount should be at least 1.')
+    return values
+
+  def _StockValues(self, row):
+    amount = _Text(row, 'amount')
+    try:
+      amount = int(amount)
+    except (TypeError, ValueError):
+      raise RowError('The amount should be a whole number.')
+    if abs(amount) > MAXSTOCKAMOUNT:
+      raise RowError('The amount is out of range.')
+    return {'product': _Name(row, 'product'),
+            'amount': amount,
+            'reference': _Text(row, 'reference', 45),
+            'lot': _Text(row, 'lot', 45)}
+
+  def _Products(self, rows):
+    """Writes the new products, skipping names that are taken."""
+    self._Lookup({values['name'] for _line, values in rows})
+    new = []
+    names = set()
+    for line, values in rows:
+      if values['name'] in self.products or values['name'] in names:
+        self._Error(line, 'A product named %r already exists.' % values['name'])
+      else:
+        names.add(values['name'])
+        new.append((line, values))
+    self._Write('product', new, self._InsertProducts)
+    if new:
+      cache.COUNTS.Invalidate(model.Product.TableName())
+      cache.PAGES.Invalidate()
+
+  def _InsertProducts(self, cursor, values):
+    """Inserts the products and records the IDs they were given."""
+    cursor.Insert(table=model.Product.TableName(), values=values)
+    rows = cursor.Select(table=model.Product.TableName(),
+                         fields=('ID', 'name'),
+                         conditions=['name in (%s)' % ', '.join(
+                                         self.connection.EscapeValues(
+                                             product['name'])
+                                         for product in values),
+                                     model.NOTDELETED],
+                         escape=False)
+    for row in rows:
+      self.products[row['name']] = int(row['ID'])
+    model.Productversion.Bump(cursor, [model.Productversion.CATALOG] + [
+        int(row['ID']) for row in rows])
+
+  def _Lookup(self, names):
+    """Looks up the IDs of the named products that are not known yet."""
+    unknown = set(names) - set(self.products)
+    for name, product in model.Product.FromNames(self.connection,
+                                                 unknown).items():
+      self.products[name] = product.key
+
+  def _Resolve(self, rows, fields):
+    """Replaces the product names in the rows by their IDs, reporting the rows
+    that refer to unknown products."""
+    resolved = []
+    for line, values in rows:
+      missing = [values[field] for field in fields
+                 if values[field] not in self.products]
+      if missing:
+        self._Error(line, 'There is no product with common name %r' % missing[0])
+        continue
+      values = dict(values)
+      for field in fields:
+        values[field] = self.products[values[field]]
+      resolved.append((line, values))
+    return resolved
+
+  def _Write(self, kind, rows, write):
+    """Writes the rows in a single transaction.
+
+    When that fails on the data, the rows are written one by one so only the
+    rows that cause the failure are reported.
+    """
+    if not rows:
+      return
+    try:
+      with self.connection as cursor:
+        write(cursor, [values for _line, values in rows])
+    except (self.connection.IntegrityError, self.connection.DataError,
+            model.AssemblyError) as error:
+      if len(rows) == 1:
+        self._Error(rows[0][0], error)
+        return
+      for row in rows:
+        self._Write(kind, [row], write)
+      return
+    self.created[kind] += len(rows)
@@ -0,0 +1,274 @@
+#!/usr/bin/python3
+"""Query instrumentation for the warehouse.
+
+Every query sent over an instrumented connection is counted and timed against
+the request that is being handled by the current thread. Finished requests are
+aggregated per handler into histograms, which are rendered in the Prometheus
+text format. The aggregates live in the memory of a single worker process,
+and are labelled with its process ID.
+Queries that take longer than the configured threshold go to the slow query
+log.
+"""
+
+# standard modules
+import bisect
+import functools
+import heapq
+import logging
+import os
+import threading
+import time
+
+# Handlers are recognised by these method name prefixes.
+HANDLERPREFIXES = 'Request', 'Json', 'Handle'
+# Upper bounds of the histogram buckets, in seconds and in queries.
+TIMEBUCKETS = 0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10
+QUERYBUCKETS = 1, 2, 5, 10, 20, 50, 100, 200, 500, 1000
+# The amount of slowest statements kept per request.
+SLOWEST = 5
+# Statements are cut off at this length in the request overview and log.
+STATEMENTLENGTH = 1000
+
+SETTINGS = {'slowquery': 0.5, 'slowlog': None}
+SLOWLOG = logging.getLogger('warehouse.slowquery')
+_CURRENT = threading.local()
+
+
+class RequestStats:
+  """The queries of a single request."""
+  def __init__(self, handler=None):
+    self.handler = handler
+    self.start = time.perf_counter()
+    self.end = None
+    self.queries = 0
+    self.dbtime = 0.0
+    self.slow = 0
+    self._slowest = []
+
+  def Record(self, statement, duration):
+    """Adds a query and its duration in seconds."""
+    self.queries += 1
+    self.dbtime += duration
+    if duration >= SETTINGS['slowquery']:
+      self.slow += 1
+    entry = duration, self.queries, statement
+    if len(self._slowest) < SLOWEST:
+      heapq.heappush(self._slowest, entry)
+    elif entry > self._slowest[0]:
+      heapq.heapreplace(self._slowest, entry)
+
+  @property
+  def elapsed(self):
+    """Seconds since the start of the request, up to its end if it ended."""
+    return (self.end or time.perf_counter()) - self.start
+
+  @property
+  def slowest(self):
+    """The slowest statements of the request, slowest first."""
+    return [{'duration': round(duration * 1000, 2), 'statement': statement}
+            for duration, _order, statement in sorted(self._slowest,
+                                                      reverse=True)]
+
+  def Overview(self):
+    """Returns the stats as a dict, with times in milliseconds."""
+    return {'handler': self.handler,
+            'queries': self.queries,
+            'dbtime': round(self.dbtime * 1000, 2),
+            'elapsed': round(self.elapsed * 1000, 2),
+            'slowest': self.slowest}
+
+  def ServerTiming(self):
+    """Returns the value for a Server-Timing response header."""
+    return 'db;dur=%.2f;desc="%d queries", total;dur=%.2f' % (
+        self.dbtime * 1000, self.queries, self.elapsed * 1000)
+
+
+class Histogram:
+  """Counts observations in cumulative buckets."""
+  def __init__(self, buckets):
+    self.buckets = buckets
+    self.counts = [0] * (len(buckets) + 1)
+    self.sum = 0
+    self.count = 0
+
+  def Observe(self, value):
+    self.counts[bisect.bisect_left(self.buckets, value)] += 1
+    self.sum += value
+    self.count += 1
+
+  def Render(self, name, labels):
+    """Yields the lines for the histogram in the Prometheus text format."""
+    cumulative = 0
+    for bound, count in zip(self.buckets + ('+Inf',), self.counts):
+      cumulative += count
+      yield '%s_bucket{%s,le="%s"} %d' % (name, labels, bound, cumulative)
+    yield '%s_sum{%s} %s' % (name, labels, round(self.sum, 6))
+    yield '%s_count{%s} %d' % (name, labels, self.count)
+
+
+class Metrics:
+  """Aggregates finished requests per handler."""
+  HISTOGRAMS = (
+      ('warehouse_request_seconds', 'Time spent handling the request.',
+       'elapsed', TIMEBUCKETS),
+      ('warehouse_request_db_seconds', 'Time spent waiting on queries.',
+       'dbtime', TIMEBUCKETS),
+      ('warehouse_request_queries', 'Queries sent per request.',
+       'queries', QUERYBUCKETS))
+
+  def __init__(self):
+    self.handlers = {}
+    self.slow = {}
+    self._lock = threading.Lock()
+
+  def Record(self, stats):
+    """Adds the stats of a finished request to its handler's histograms."""
+    with self._lock:
+      if stats.handler not in self.handlers:
+        self.handlers[stats.handler] = [
+            Histogram(buckets) for _name, _help, _field, buckets
+            in self.HISTOGRAMS]
+        self.slow[stats.handler] = 0
+      for histogram, (_name, _help, field, _buckets) in zip(
+          self.handlers[stats.handler], self.HISTOGRAMS):
+        histogram.Observe(getattr(stats, field))
+      self.slow[stats.handler] += stats.slow
+
+  def Render(self):
+    """Returns all metrics in the Prometheus text format."""
+    lines = []
+    worker = os.getpid()
+    with self._lock:
+      handlers = sorted(self.handlers)
+      for index, (name, description, _field, _buckets) in enumerate(
+          self.HISTOGRAMS):
+        lines.append('# HELP %s %s' % (name, description))
+        lines.append('# TYPE %s histogram' % name)
+        for handler in handlers:
+          lines.extend(self.handlers[handler][index].Render(
+              name, 'handler="%s",worker="%d"' % (handler, worker)))
+      lines.append('# HELP warehouse_slow_queries_total Queries slower than '
+                   'the slow query threshold.')
+      lines.append('# TYPE warehouse_slow_queries_total counter')
+      for handler in handlers:
+        lines.append(
+            'warehouse_slow_queries_total{handler="%s",worker="%d"} %d' % (
+                handler, worker, self.slow[handler]))
+    return '\n'.join(lines) + '\n'
+
+
+METRICS = Metrics()
+
+
+def Configure(options):
+  """Applies the [instrument] config section.
+
+  Arguments:
+    @ options: dict
+      % slowquery: str ~~ 0.5
+        Seconds after which a query goes to the slow query log.
+      % slowlog: str ~~ None
+        File the slow query log is written to, instead of the default log.
+  """
+  SETTINGS['slowquery'] = float(options.get('slowquery', 0.5))
+  slowlog = options.get('slowlog') or None
+  if slowlog == SETTINGS['slowlog']:
+    return
+  for handler in list(SLOWLOG.handlers):
+    SLOWLOG.removeHandler(handler)
+    handler.close()
+  if slowlog:
+    handler = logging.FileHandler(slowlog)
+    handler.setFormatter(logging.Formatter('%(asctime)s %(message)s'))
+    SLOWLOG.addHandler(handler)
+    SLOWLOG.setLevel(logging.WARNING)
+  SLOWLOG.propagate = not slowlog
+  SETTINGS['slowlog'] = slowlog
+
+
+def Instrument(connection):
+  """Wraps the query method of the connection so its queries are recorded.
+
+  Wrapping is done once per connection, later calls return directly.
+  """
+  if getattr(connection, '_instrumented', False):
+    return connection
+  for name in ('Query', 'query'):
+    if hasattr(connection, name):
+      setattr(connection, name, _Timed(getattr(connection, name)))
+      break
+  connection._instrumented = True
+  return connection
+
+
+def _Timed(query):
+  """Returns the query method, timing each call."""
+  @functools.wraps(query)
+  def timed(statement, *args, **kwargs):
+    start = time.perf_counter()
+    try:
+      return query(statement, *args, **kwargs)
+    finally:
+      duration = time.perf_counter() - start
+      if isinstance(statement, bytes):
+        statement = statement.decode('utf8', 'replace')
+      statement = statement[:STATEMENTLENGTH]
+      stats = Current()
+      if stats is not None:
+        stats.Record(statement, duration)
+      if duration >= SETTINGS['slowquery']:
+        SLOWLOG.warning('%.3fs %s: %s', duration,
+                        stats.handler if stats else '-', statement)
+  return timed
+
+
+def Begin(handler=None):
+  """Starts recording the queries of a new request on this thread."""
+  _CURRENT.stats = RequestStats(handler)
+  return _CURRENT.stats
+
+
+def Current():
+  """Returns the stats of the request on this thread, or None."""
+  return getattr(_CURRENT, 'stats', None)
+
+
+def End(record=True):
+  """Ends the request on this thread and returns its stats.
+
+  Requests that were handled by a tagged handler are added to the metrics.
+  """
+  stats = Current()
+  _CURRENT.stats = None
+  if stats is not None:
+    stats.end = time.perf_counter()
+    if record and stats.handler is not None:
+      METRICS.Record(stats)
+  return stats
+
+
+def Tag(handler):
+  """Names the handler of the current request, the first handler called for a
+  request is the one it is tagged with."""
+  stats = Current()
+  if stats is not None and stats.handler is None:
+    stats.handler = handler
+
+
+def TagHandlers(cls):
+  """Class decorator that tags requests with the handler method serving them.
+
+  Methods whose name starts with one of the HANDLERPREFIXES are wrapped.
+  """
+  for name, method in list(vars(cls).items()):
+    if name.startswith(HANDLERPREFIXES) and callable(method):
+      setattr(cls, name, _Tagged(name, method))
+  return cls
+
+
+def _Tagged(name, method):
+  @functools.wraps(method)
+  def tagged(*args, **kwargs):
+    Tag(name)
+    return method(*args, **kwargs)
+  return tagged
@@ -10,50 +10,184 @@ import pytz
 import re
 import json
 import math
+import collections
 
 # Custom modules
 from uweb3 import model
-from passlib.hash import pbkdf2_sha256
 import secrets
 
+# Application
+from . import cache
+from . import passwords
+
 NOTDELETEDDATE = '1000-01-01 00:00:00'
 NOTDELETED = 'dateDeleted = "%s"' % NOTDELETEDDATE
+SEARCHNGRAMSIZE = 2  # the ngram_token_size of the product search index
+NOFULLTEXTINDEX = 1191  # MySQL error for a MATCH without a FULLTEXT index
+NAMEPATTERN = re.compile(r'[\w\-\.,]+')
+# MySQL error raised on the transaction that InnoDB rolls back to resolve a
+# deadlock, and how often such a transaction is retried.
+DEADLOCK = 1213
+DEADLOCKRETRIES = 3
+
+
+def NormalizeName(name, length=255):
+  """Returns the common name for a product or supplier.
+
+  Spaces are replaced by underscores, and the first run of word characters,
+  dashes, dots and commas is used as the name. An empty string is returned
+  when the name holds none of those.
+
+  Arguments:
+    @ name: str
+      The name as entered.
+    % length: int ~~ 255
+      The maximum length of the name.
+  """
+  match = NAMEPATTERN.search(name.replace(' ', '_'))
+  return match.group(0)[:length] if match else ''
+
+
+def Transaction(connection, work, retries=DEADLOCKRETRIES):
+  """Runs work(cursor) in a transaction and returns its result.
+
+  When InnoDB rolls the transaction back to resolve a deadlock, it is run
+  again from the start, up to the given amount of retries.
+  """
+  for attempt in range(retries + 1):
+    try:
+      with connection as cursor:
+        return work(cursor)
+    except connection.OperationalError as error:
+      if error.args[:1] != (DEADLOCK,) or attempt == retries:
+        raise
+
+
+def _IdList(ids):
+  """Returns the given record IDs as a comma separated SQL list."""
+  return ','.join(str(int(recordid)) for recordid in sorted(ids))
+
+
+def Prefetch(connection, records, field, foreign):
+  """Loads the foreign records referenced by a field in a single query.
+
+  The loaded records are attached to the given records, so reading the field
+  no longer needs a query per record.
+
+  Arguments:
+    @ connection: sqltalk.connection
+      Database connection to use.
+    @ records: list of model.Record
+      The records that reference the foreign records.
+    @ field: str
+      The name of the field holding the foreign key.
+    @ foreign: model.Record subclass
+      The class of the referenced records.
+
+  Returns:
+    list: the given records.
+  """
+  keys = {int(dict.get(record, field)) for record in records
+          if dict.get(record, field) is not None and
+          not isinstance(dict.get(record, field), model.Record)}
+  if not keys:
+    return records
+  with connection as cursor:
+    rows = cursor.Select(table=foreign.TableName(),
+                         conditions=['%s in (%s)' % (foreign._PRIMARY_KEY,
+                                                     _IdList(keys))],
+                         escape=False)
+  loaded = {}
+  for row in rows:
+    loaded[int(row[foreign._PRIMARY_KEY])] = foreign(connection, row)
+  for record in records:
+    value = dict.get(record, field)
+    if not isinstance(value, model.Record) and value is not None and int(value) in loaded:
+      record[field] = loaded[int(value)]
+  return records
 
 class Product(model.Record):
   """Provides a model abstraction for the Product table"""
   _possiblestock = None
   _parts = None
   _products = None
+  _resolver = None
+  _fulltext = True
 
   @classmethod
-  def List(cls, connection, conditions=[], *args, **kwargs):
-    """Returns the Products filtered on not deleted"""
-    return super().List(
+  def List(cls, connection, conditions=[], *args, prefetch=(), **kwargs):
+    """Returns the Products filtered on not deleted
+
+      Arguments:
+      % prefetch: iterable of str ~~ ()
+        Foreign fields to load for all listed products at once, eg. supplier.
+    """
+    products = super().List(
       connection,
       conditions=[NOTDELETED] + conditions,
       *args, **kwargs)
+    if not prefetch:
+      return products
+    products = list(products)
+    total = products[:1] if kwargs.get('yield_unlimited_total_first') else []
+    foreign = {'supplier': Supplier}
+    for field in prefetch:
+      Prefetch(connection, products[len(total):], field, foreign[field])
+    return products
 
   @classmethod
   def Search(cls, connection, query=None, order=None, conditions=None, **kwargs):
     """Returns the products matching the search
 
+    The search uses the full text index on name, sku, ean and description.
+    Unless an order is given the best matching products are returned first.
+    Queries with terms shorter than the index's ngram size, and databases
+    without the index, fall back to filtering on name.
+
       Arguments:
       @ connection: sqltalk.connection
         Database connection to use.
       % query: str
-        Filters on name
+        Filters on name, sku, ean and description
     """
     if not conditions:
       conditions = []
     queryorder = [('product.dateCreated', True)]
     if order:
       queryorder = order + queryorder
+    match = cls._SearchMatch(connection, query or '')
+    if match and cls._fulltext:
+      try:
+        return list(cls.List(
+          connection,
+          conditions=[match] + conditions,
+          order=queryorder if order else [(match, True)] + queryorder,
+          escape=False,
+          **kwargs))
+      except (connection.OperationalError, connection.ProgrammingError) as error:
+        if error.args[:1] != (NOFULLTEXTINDEX,):
+          raise
+        # The full text index is missing, stop trying for this worker.
+        Product._fulltext = False
     return cls.List(
       connection,
       conditions=['name like "%%%s%%"' % connection.EscapeValues(query)[1:-1]] + conditions,
       order=queryorder,
       **kwargs)
 
+  @staticmethod
+  def _SearchMatch(connection, query):
+    """Returns the full text match expression for the query.
+
+    Every term in the query needs to be present in the product. None is
+    returned when a term is too short to be found through the index.
+    """
+    terms = re.sub(r'[+\-<>()~*"@]', ' ', query).split()
+    if not terms or min(len(term) for term in terms) < SEARCHNGRAMSIZE:
+      return None
+    return 'MATCH (name, sku, ean, description) AGAINST (%s IN BOOLEAN MODE)' % (
+        connection.EscapeValues(' '.join('+"%s"' % term for term in terms)))
+
   @classmethod
   def FromName(cls, connection, name, conditions=None):
     """Returns the product of the given common name.
@@ -83,17 +217,101 @@ class Product(model.Record):
           'There is no product with common name %r' % name)
     return cls(connection, product[0])
 
+  @classmethod
+  def FromNames(cls, connection, names):
+    """Returns the products for the given common names in a single query.
+
+    Arguments:
+      @ connection: sqltalk.connection
+        Database connection to use.
+      @ names: iterable of str
+        The common names of the products.
+
+    Returns:
+      dict: product abstraction classes keyed by the given names. Names match
+            regardless of case, like they do in the database. Names that do
+            not exist are left out.
+    """
+    names = set(names)
+    if not names:
+      return {}
+    with connection as cursor:
+      products = cursor.Select(table=cls.TableName(),
+                               conditions=['name in (%s)' % ', '.join(
+                                               connection.EscapeValues(name)
+                                               for name in sorted(names)),
+                                           NOTDELETED])
+    products = {product['name'].casefold(): cls(connection, product)
+                for product in products}
+    return {name: products[name.casefold()] for name in names
+            if name.casefold() in products}
+
+  @classmethod
+  def FromIdentifiers(cls, connection, names=(), ids=(), eans=(), skus=()):
+    """Returns the products matching any of the given identifiers, in a single
+    query.
+
+    Arguments:
+      @ connection: sqltalk.connection
+        Database connection to use.
+      % names: iterable of str ~~ ()
+        Common names of products.
+      % ids: iterable of int ~~ ()
+        Product IDs.
+      % eans: iterable of str ~~ ()
+        EAN barcodes, a barcode can match several products.
+      % skus: iterable of str ~~ ()
+        SKUs, a SKU can match a product of every supplier.
+
+    Returns:
+      list: product abstraction classes, ordered by ID.
+    """
+    matches = []
+    for field, values in (('name', names), ('ean', eans), ('sku', skus)):
+      values = sorted(set(values))
+      if values:
+        matches.append('`%s` in (%s)' % (field, ', '.join(
+            connection.EscapeValues(value) for value in values)))
+    if ids:
+      matches.append('`ID` in (%s)' % _IdList(ids))
+    if not matches:
+      return []
+    with connection as cursor:
+      products = cursor.Select(table=cls.TableName(),
+                               conditions=['(%s)' % ' OR '.join(matches),
+                                           NOTDELETED],
+                               order=[('ID', False)],
+                               escape=False)
+    return [cls(connection, product) for product in products]
+
   def Delete(self):
     """Overwrites the default Delete and sets the dateDeleted datetime instead"""
     self['dateDeleted'] = str(pytz.utc.localize(
         datetime.datetime.utcnow()))[0:19]
     self.Save()
 
+  @classmethod
+  def Create(cls, *args, **kwargs):
+    """Creates the product, and invalidates the cached listing counts and
+    rendered listings once committed."""
+    product = super().Create(*args, **kwargs)
+    cache.COUNTS.Invalidate(cls.TableName())
+    cache.PAGES.Invalidate()
+    return product
+
+  def Save(self, *args, **kwargs):
+    """Saves the product, and invalidates the cached listing counts and
+    rendered listings once committed, a save might have deleted this product
+    or moved it to another supplier."""
+    result = super().Save(*args, **kwargs)
+    cache.COUNTS.Invalidate(self.TableName())
+    cache.PAGES.Invalidate()
+    return result
+
   def _PreCreate(self, cursor):
     super()._PreCreate(cursor)
     if self['name']:
-      self['name'] = re.search('([\w\-_\.,]+)',
-          self['name'].replace(' ', '_')).groups()[0][:255]
+      self['name'] = NormalizeName(self['name'])
     if not self['gs1']: # set empty string to None for key contraints
       self['gs1'] = None
     if not self['sku']: # set empty string to None for key contraints
@@ -104,8 +322,7 @@ class Product(model.Record):
   def _PreSave(self, cursor):
     super()._PreSave(cursor)
     if self['name']:
-      self['name'] = re.search('([\w\-_\.,]+)',
-          self['name'].replace(' ', '_')).groups()[0][:255]
+      self['name'] = NormalizeName(self['name'])
     if not self['gs1']: # set empty string to None for key contraints
       self['gs1'] = None
     if not self['sku']: # set empty string to None for key contraints
@@ -113,11 +330,26 @@ class Product(model.Record):
     if not self['name']:
       raise InvalidNameError('Provide a valid name')
 
+  def _PostCreate(self, cursor):
+    super()._PostCreate(cursor)
+    Productversion.Bump(cursor, [self.key, Productversion.CATALOG])
+
+  def _PostSave(self, cursor):
+    """Bumps the version of the product and the catalog. The assemblies using
+    this product show its details, so their versions are bumped along with
+    its own."""
+    super()._PostSave(cursor)
+    Productversion.Bump(cursor, {self.key, Productversion.CATALOG} |
+                                Productpart.WhereUsed(cursor, [self.key]))
+
   @property
   def parts(self):
     """List products used as parts for this product"""
     if self._parts is None:
-      self._parts = list(self._Children(Productpart))
+      if self._resolver is not None:
+        self._parts = self._resolver.Parts(self)
+      else:
+        self._parts = list(self._Children(Productpart))
     return self._parts
 
   @property
@@ -134,71 +366,36 @@ class Product(model.Record):
   @property
   def currentstock(self):
     """Returns the current stock"""
-    with self.connection as cursor:
-      stock = cursor.Select(table=Stock.TableName(),
-                            fields='sum(amount) as currentstock',
-                            conditions=['product=%d' % self.key],
-                            escape=False)
-    if stock[0]['currentstock']:
-      return int(stock[0]['currentstock'])
-    return 0
+    return Stockbalance.ForProducts(self.connection, [self.key]).get(self.key, 0)
 
   @property
   def possiblestock(self):
     """Returns the possible stock when using up currently available parts"""
-    if self._possiblestock:
-      return self._possiblestock
-
-    parts = list(self.parts)
-    if not parts:
-      self._possiblestock = {'available': 0,
-                             'parts': None,
-                             'limitedby': None}
-      return self._possiblestock
-
-    limitedby = parts[0]
-    availableassemblies = math.inf
-    for part in parts:
-      part['availablestock'] = part['part'].currentstock
-      part['availablepossiblestock'] = part['part'].possiblestock
-      if part['amount']:
-        part['availableassemblies'] = int((part['availablestock'] + part['availablepossiblestock']['available']) / part['amount'])
-        if part['availableassemblies'] < availableassemblies:
-          limitedby = part
-        availableassemblies = min(availableassemblies, part['availableassemblies'])
-
-    self._possiblestock = {'available': availableassemblies,
-                           'parts': parts,
-                           'limitedby': limitedby}
+    if self._possiblestock is None:
+      resolver = self._resolver or BomResolver(self.connection)
+      self._possiblestock = resolver.PossibleStock(self)
     return self._possiblestock
 
   def Assemble(self, amount=1, reference='Assembled from parts', lot=None):
-    """Tries to use up this products parts and assembles them, mutating stock on all products involved."""
-    if amount > 0:
-      possiblestock = self.possiblestock
-      if not possiblestock['available'] and not possiblestock['limitedby']:
-        raise AssemblyError('Cannot assemble this product, is not an assembled product.')
-      if not possiblestock['available'] or possiblestock['available'] < amount:
-        raise AssemblyError('Cannot assemble this product, not enough parts. Limited by: %s' % possiblestock['limitedby']['part']['name'])
-      parts = possiblestock['parts']
-    elif amount < 0:
-      if self.currentstock < abs(amount):
-        raise AssemblyError('Cannot Disassemble this product, not enough stock available.')
-      parts = list(self.parts)
-      if parts == 0:
-        raise AssemblyError('Cannot Disassemble this product, is not an assembled product.')
+    """Tries to use up this products parts and assembles them, mutating stock on all products involved.
 
-    # Mutate parts one by one
-    for part in parts:
-      subreference = 'Assembly: %s, %s' % (self['name'], reference)
-      Stock.Create(self.connection, {'product': int(part['part']),
-                                     'amount': (part['amount'] * amount) * -1,
-                                     'reference': subreference[0:45]})
-    # Mutate this product as requested
-    return Stock.Create(self.connection, {'product': self.key,
-                                   'amount': amount,
-                                   'reference': reference[0:45] if reference else '',
-                                   'lot': lot})
+    The stock balances of all products in the bill of materials are locked
+    while availability is checked, and all stock rows are written with a
+    single insert in the same transaction.
+
+    Returns:
+      list: the stock rows that were written.
+    """
+    def Work(cursor):
+      resolver = BomResolver(self.connection, cursor)
+      try:
+        resolver.Load([self], lock=True)
+        rows = resolver.AssemblyRows(self, amount, reference, lot)
+        Stock.CreateMany(cursor, rows)
+      finally:
+        resolver.cursor = None
+      return rows
+    return Transaction(self.connection, Work)
 
   def Disassemble(self, amount=1, reference="Disassembled for parts", lot=None):
     """Remove as many assemblies as requested and create stock for parts"""
@@ -213,7 +410,15 @@ class Product(model.Record):
 
     return self.List(self.connection,
         conditions=['ID != %d' % self.key,
-                    'ID not in (%s)' % ','.join(partIds) if partIds else 'true'])
+                    'ID not in (%s)' % ','.join(partIds) if partIds else 'true',
+                    # Products that use this one would make it contain itself.
+                    'ID not in (SELECT ancestor FROM %s WHERE descendant = %d)' % (
+                        Productclosure.TableName(), self.key)])
+
+  def RawParts(self, amount=1):
+    """Returns the parts without parts of their own needed for the given amount
+    of this product, at any depth of its bill of materials."""
+    return Productclosure.RawParts(self.connection, self, amount)
 
   @property
   def Eancode(self):
@@ -227,13 +432,1138 @@ class Product(model.Record):
     return None
 
 
+class BomResolver:
+  """Resolves the bills of materials for products in bulk.
+
+  The part tree is loaded one BOM level per query, and the stock balances of
+  all products involved are fetched in a single query. Possible stock is then
+  computed bottom-up, so a sub-assembly that is used in several places is only
+  resolved once for the lifetime of the resolver. Products loaded by the
+  resolver keep a reference to it, so their `parts` and `possiblestock` share
+  the same memo.
+
+  When a cursor is given, all queries run in the transaction of that cursor.
+  """
+  def __init__(self, connection, cursor=None):
+    self.connection = connection
+    self.cursor = cursor
+    self.products = {}
+    self.parts = {}
+    self.stock = {}
+    self.possiblestock = {}
+
+  def _Select(self, **kwargs):
+    """Runs a select on the transaction's cursor, or in its own transaction."""
+    if self.cursor is not None:
+      return self.cursor.Select(**kwargs)
+    with self.connection as cursor:
+      return cursor.Select(**kwargs)
+
+  def Load(self, products, lock=False, share=False):
+    """Loads the full part trees and stock balances for the given products.
+
+    Arguments:
+      @ products: iterable of Product or int
+        The (root) products to resolve.
+      % lock: bool ~~ False
+        Locks the stock balances of all products involved until the end of the
+        resolver's transaction. This requires the resolver to have a cursor.
+      % share: bool ~~ False
+        Holds a shared lock on the stock balances instead, which keeps them
+        from changing until the end of the resolver's transaction. This also
+        requires the resolver to have a cursor.
+    """
+    products = list(products)
+    for product in products:
+      if isinstance(product, Product):
+        self.products.setdefault(product.key, product)
+        product._resolver = self
+    frontier = {int(product) for product in products} - set(self.parts)
+    self._LoadProducts(frontier)
+    while frontier:
+      for productid in frontier:
+        self.parts[productid] = []
+      rows = self._Select(table=Productpart.TableName(),
+                          conditions=['product in (%s)' % _IdList(frontier)],
+                          order=[('ID', False)],
+                          escape=False)
+      partids = {int(row['part']) for row in rows}
+      self._LoadProducts(partids)
+      for row in rows:
+        part = Productpart(self.connection, row)
+        part['part'] = self.products[int(row['part'])]
+        self.parts[int(row['product'])].append(part)
+      frontier = partids - set(self.parts)
+    if lock:
+      self.stock.update(Stockbalance.Lock(self.cursor, self.products))
+      self.Mutate(())
+    elif share:
+      self.stock.update(Stockbalance.Fetch(self.cursor, self.products,
+                                           share=True))
+      self.Mutate(())
+    else:
+      missing = set(self.products) - set(self.stock)
+      if self.cursor is not None:
+        self.stock.update(Stockbalance.Fetch(self.cursor, missing))
+      else:
+        self.stock.update(Stockbalance.ForProducts(self.connection, missing))
+
+  def _LoadProducts(self, productids):
+    """Loads the product records that have not been loaded yet."""
+    productids = set(productids) - set(self.products)
+    if not productids:
+      return
+    rows = self._Select(table=Product.TableName(),
+                        conditions=['ID in (%s)' % _IdList(productids)],
+                        escape=False)
+    for row in rows:
+      product = Product(self.connection, row)
+      product._resolver = self
+      self.products[product.key] = product
+
+  def Parts(self, product):
+    """Returns the Productparts that make up the given product."""
+    productid = int(product)
+    if productid not in self.parts:
+      self.Load([product])
+    return self.parts[productid]
+
+  def PossibleStock(self, product):
+    """Returns the possible stock when using up currently available parts.
+
+    Returns:
+      dict: 'available', the amount of products that can be assembled,
+            'parts', the Productparts with their availability and
+            'limitedby', the Productpart that limits the assembly.
+    """
+    productid = int(product)
+    if productid in self.possiblestock:
+      return self.possiblestock[productid]
+    parts = self.Parts(product)
+    # Guards against parts that (indirectly) contain their own product.
+    self.possiblestock[productid] = {'available': 0,
+                                     'parts': None,
+                                     'limitedby': None}
+    if not parts:
+      return self.possiblestock[productid]
+
+    limitedby = parts[0]
+    availableassemblies = math.inf
+    for part in parts:
+      partid = int(part['part'])
+      part['availablestock'] = self.stock.get(partid, 0)
+      part['availablepossiblestock'] = self.PossibleStock(partid)
+      if part['amount']:
+        part['availableassemblies'] = int((part['availablestock'] + part['availablepossiblestock']['available']) / part['amount'])
+        if part['availableassemblies'] < availableassemblies:
+          limitedby = part
+        availableassemblies = min(availableassemblies, part['availableassemblies'])
+
+    self.possiblestock[productid] = {'available': availableassemblies,
+                                     'parts': parts,
+                                     'limitedby': limitedby}
+    return self.possiblestock[productid]
+
+  def AssemblyRows(self, product, amount=1, reference='Assembled from parts',
+                   lot=None):
+    """Returns the stock rows that (dis)assemble the given product.
+
+    A positive amount assembles products from their parts, a negative amount
+    disassembles them back into parts. Parts that are assemblies themselves
+    and lack the stock for this assembly are assembled from their own parts
+    first. No stock is written, the rows can be passed on to
+    `Stock.CreateMany`, but the loaded balances are updated with them.
+
+    Raises:
+      AssemblyError:
+        The product is not an assembled product, or there are not enough parts
+        or products available. The loaded balances are left untouched.
+    """
+    stock = dict(self.stock)
+    try:
+      return self._AssemblyRows(int(product), amount, reference, lot)
+    except AssemblyError:
+      self.stock = stock
+      self.Mutate(())
+      raise
+
+  def _AssemblyRows(self, productid, amount, reference, lot):
+    """Returns and applies the stock rows for a single (dis)assembly."""
+    parts = self.Parts(productid)
+    if amount > 0:
+      possiblestock = self.PossibleStock(productid)
+      if not possiblestock['available'] and not possiblestock['limitedby']:
+        raise AssemblyError('Cannot assemble this product, is not an assembled product.')
+      if not possiblestock['available'] or possiblestock['available'] < amount:
+        raise AssemblyError('Cannot assemble this product, not enough parts. Limited by: %s' % possiblestock['limitedby']['part']['name'])
+    elif amount < 0:
+      if self.stock.get(productid, 0) < abs(amount):
+        raise AssemblyError('Cannot Disassemble this product, not enough stock available.')
+      if not parts:
+        raise AssemblyError('Cannot Disassemble this product, is not an assembled product.')
+
+    subreference = 'Assembly: %s, %s' % (self.products[productid]['name'],
+                                         reference)
+    rows = []
+    if amount > 0:
+      for part in parts:
+        partid = int(part['part'])
+        shortage = part['amount'] * amount - self.stock.get(partid, 0)
+        if shortage > 0 and self.Parts(partid):
+          rows.extend(self._AssemblyRows(partid, shortage, subreference, None))
+    assembly = [{'product': int(part['part']),
+                 'amount': (part['amount'] * amount) * -1,
+                 'reference': subreference[0:45],
+                 'lot': None} for part in parts]
+    assembly.append({'product': productid,
+                     'amount': amount,
+                     'reference': reference[0:45] if reference else '',
+                     'lot': lot})
+    self.Mutate(assembly)
+    return rows + assembly
+
+  def Mutate(self, rows):
+    """Applies the given stock rows to the loaded balances.
+
+    The memoized possible stock is discarded, as it depends on the balances.
+    """
+    for row in rows:
+      productid = int(row['product'])
+      self.stock[productid] = self.stock.get(productid, 0) + int(row['amount'])
+    self.possiblestock.clear()
+    for product in self.products.values():
+      product._possiblestock = None
+
+
 class Stock(model.Record):
   """Provides a model abstraction for the stock table"""
+  EXPORTFIELDS = 'ID', 'date', 'product', 'amount', 'reference', 'lot'
+
+  def _PostCreate(self, cursor):
+    """Updates the product's stock balance in the same transaction."""
+    super()._PostCreate(cursor)
+    Stockbalance.Mutate(cursor,
+                        {int(dict.__getitem__(self, 'product')): self['amount']})
+
+  @classmethod
+  def CreateMany(cls, cursor, rows):
+    """Writes the given stock rows with a single multi-row INSERT.
+
+    The stock balances of the products involved are updated using the same
+    cursor, and thus in the same transaction.
+
+    Arguments:
+      @ cursor: sqltalk.cursor
+        Cursor of the transaction to write the stock rows in.
+      @ rows: list of dict
+        Stock rows with the product ID, amount, reference and lot.
+    """
+    if not rows:
+      return
+    mutations = {}
+    values = []
+    for row in rows:
+      productid = int(row['product'])
+      mutations[productid] = mutations.get(productid, 0) + int(row['amount'])
+      values.append({'product': productid,
+                     'amount': int(row['amount']),
+                     'reference': row.get('reference'),
+                     'lot': row.get('lot')})
+    cursor.Insert(table=cls.TableName(), values=values)
+    Stockbalance.Mutate(cursor, mutations)
+
+  @classmethod
+  def Batch(cls, connection, lines):
+    """Processes a batch of stock mutations in a single transaction.
+
+    Products are looked up in one query and their bills of materials are
+    resolved in bulk, while the stock balances of all products involved are
+    locked for the duration of the transaction. Just like a single stock
+    mutation through the API, a
+    product that is sold beyond its current stock is assembled from its parts
+    first. Lines that cannot be processed are reported and skipped, all other
+    lines are written together.
+
+    Arguments:
+      @ connection: sqltalk.connection
+        Database connection to use.
+      @ lines: list of dict
+        Stock mutations with the product name, amount and optionally a
+        reference and lot.
+
+    Returns:
+      list: a result dict for every line, holding either the resulting stock
+            or the error for that line.
+    """
+    products = Product.FromNames(connection, (
+        line['product'] for line in lines
+        if isinstance(line, dict) and isinstance(line.get('product'), str)))
+    def Work(cursor):
+      resolver = BomResolver(connection, cursor)
+      try:
+        resolver.Load(products.values(), lock=True)
+        results = cls._BatchLines(resolver, products, lines)
+        cls.CreateMany(cursor, [row for result in results
+                                for row in result.pop('rows', ())])
+      finally:
+        resolver.cursor = None
+      return results
+    return Transaction(connection, Work)
+
+  @staticmethod
+  def _BatchLines(resolver, products, lines):
+    """Plans the stock rows for each line of a batch on the given resolver."""
+    results = []
+    for index, line in enumerate(lines):
+      result = {'line': index}
+      try:
+        if not isinstance(line, dict):
+          raise ValueError('Stock lines should be objects.')
+        result['product'] = line.get('product')
+        if result['product'] not in products:
+          raise NotExistError(
+              'There is no product with common name %r' % result['product'])
+        product = products[result['product']]
+        amount = int(line.get('amount', -1))
+        reference = str(line.get('reference') or '')
+        assembled = 0
+        linerows = []
+        currentstock = resolver.stock.get(product.key, 0)
+        if (amount < 0 and # only assemble when we sell
+            abs(amount) > currentstock): # only assemble when we have not enough stock
+          assembled = abs(amount) - currentstock
+          linerows = resolver.AssemblyRows(
+              product, assembled,
+              'Assembly for %s' % reference if reference else None)
+        linerows.append({'product': product.key,
+                         'amount': amount,
+                         'reference': reference[0:45],
+                         'lot': line.get('lot')})
+      except (ValueError, TypeError, NotExistError, AssemblyError) as error:
+        result['error'] = str(error)
+      else:
+        resolver.Mutate(linerows[-1:])
+        result.update({'amount': amount,
+                       'assembled': assembled,
+                       'currentstock': resolver.stock[product.key],
+                       'rows': linerows})
+      results.append(result)
+    return results
+
+  @classmethod
+  def Export(cls, connection, product=None, start=None, end=None, lot=None,
+             chunksize=1000):
+    """Yields the stock ledger rows matching the filters, oldest first.
+
+    Rows are read from the stock archive and then the ledger, in chunks, each
+    of which seeks past the last row of the previous chunk on an index and runs
+    in a transaction of its own. Memory use stays constant however long the
+    ledger is, and no transaction is held open while the rows are being sent.
+
+    Arguments:
+      @ connection: sqltalk.connection
+        Database connection to use.
+      % product: int ~~ None
+        Only export the rows of the product with this ID.
+      % start: datetime.date ~~ None
+        The first day to export.
+      % end: datetime.date ~~ None
+        The last day to export.
+      % lot: str ~~ None
+        Only export the rows of this lot.
+      % chunksize: int ~~ 1000
+        Amount of rows read per query.
+
+    Yields:
+      dict: the ID, date, product name, amount, reference and lot of a row.
+    """
+    conditions = []
+    if product is not None:
+      conditions.append('stock.product = %d' % int(product))
+    if start is not None:
+      conditions.append("stock.dateCreated >= '%s'" % start.isoformat())
+    if end is not None:
+      conditions.append("stock.dateCreated < '%s'" % (
+          end + datetime.timedelta(days=1)).isoformat())
+    if lot is not None:
+      conditions.append('stock.lot = %s' % connection.EscapeValues(lot))
+    # A single product's rows are read in date order using its index, the
+    # full ledger in primary key order.
+    order = ('stock.dateCreated, stock.ID' if product is not None
+             else 'stock.ID')
+    # Archived rows predate the rows still in the ledger, so they go first.
+    for table in (Stockarchive.TableName(), cls.TableName()):
+      last = None
+      while True:
+        seek = list(conditions)
+        if last is not None:
+          seek.append(cls._ExportAfter(last, product is not None))
+        with connection as cursor:
+          rows = list(cursor.Execute("""
+              SELECT stock.ID, stock.dateCreated, product.name AS product,
+                     stock.amount, stock.reference, stock.lot
+              FROM `%s` AS stock
+              JOIN `%s` AS product ON product.ID = stock.product
+              %s
+              ORDER BY %s
+              LIMIT %d""" % (table, Product.TableName(),
+                             'WHERE %s' % ' AND '.join(seek) if seek else '',
+                             order, chunksize)))
+        for row in rows:
+          yield {'ID': int(row['ID']),
+                 'date': row['dateCreated'],
+                 'product': row['product'],
+                 'amount': int(row['amount']),
+                 'reference': row['reference'],
+                 'lot': row['lot']}
+        if len(rows) < chunksize:
+          break
+        last = rows[-1]
+
+  @staticmethod
+  def _ExportAfter(row, bydate):
+    """Returns the condition for ledger rows that follow the given row.
+
+    MySQL sorts NULL values first, so rows without a date come first."""
+    if not bydate:
+      return 'stock.ID > %d' % int(row['ID'])
+    if row['dateCreated'] is None:
+      return '(stock.dateCreated IS NOT NULL OR stock.ID > %d)' % int(row['ID'])
+    return ("(stock.dateCreated > '%(date)s' OR "
+            "(stock.dateCreated = '%(date)s' AND stock.ID > %(ID)d))" % {
+                'date': row['dateCreated'], 'ID': int(row['ID'])})
+
+
+class Stockbalance(model.Record):
+  """Provides a model abstraction for the stockbalance table
+
+  The stock balance holds the running total of the stock ledger for each
+  product. It is updated along with every stock mutation so reading the
+  current stock does not need to aggregate the full ledger.
+  """
+  _PRIMARY_KEY = 'product'
+
+  @classmethod
+  def Mutate(cls, cursor, mutations):
+    """Adds the given amounts to the stored balances.
+
+    The cached possible stock of the assemblies that use these products is
+    removed in the same transaction, and the versions of the products and
+    those assemblies are bumped.
+
+    Arguments:
+      @ cursor: sqltalk.cursor
+        Cursor of the transaction that writes the matching stock rows.
+      @ mutations: dict
+        Mapping of product ID to the amount its stock changes by.
+    """
+    values = ['(%d, %d)' % (int(product), int(amount))
+              for product, amount in sorted(mutations.items()) if amount]
+    if not values:
+      return
+    cursor.Execute("""
+        INSERT INTO `%s` (`product`, `amount`)
+        VALUES %s
+        ON DUPLICATE KEY UPDATE `amount` = `amount` + VALUES(`amount`)""" % (
+            cls.TableName(), ', '.join(values)))
+    assemblies = Productpart.WhereUsed(cursor, mutations)
+    Possiblestock.Invalidate(cursor, assemblies)
+    Productversion.Bump(cursor, assemblies | {
+        int(product) for product, amount in mutations.items() if amount})
+
+  @classmethod
+  def ForProducts(cls, connection, products):
+    """Returns a dictionary of product ID to current stock.
+
+    Products without any stock mutations are reported with a stock of 0.
+    """
+    with connection as cursor:
+      return cls.Fetch(cursor, products)
+
+  @classmethod
+  def Fetch(cls, cursor, products, share=False):
+    """Returns a dictionary of product ID to current stock, read on the given
+    cursor.
+
+    Arguments:
+      % share: bool ~~ False
+        Holds a shared lock on the balances until the end of the cursor's
+        transaction, stock mutations of these products wait for it.
+    """
+    productids = {int(product) for product in products}
+    if not productids:
+      return {}
+    balances = dict.fromkeys(productids, 0)
+    if share:
+      rows = cursor.Execute("""
+          SELECT `product`, `amount`
+          FROM `%s`
+          WHERE `product` in (%s)
+          LOCK IN SHARE MODE""" % (cls.TableName(), _IdList(productids)))
+    else:
+      rows = cursor.Select(table=cls.TableName(),
+                           fields=('product', 'amount'),
+                           conditions=['product in (%s)' % _IdList(productids)],
+                           escape=False)
+    for row in rows:
+      balances[int(row['product'])] = int(row['amount'])
+    return balances
+
+  @classmethod
+  def Lock(cls, cursor, products):
+    """Locks and returns the balances of the given products.
+
+    The balances stay locked until the cursor's transaction ends, any
+    concurrent transaction that wants to lock or mutate them waits for it.
+    Balances are locked in product order to prevent deadlocks. Missing
+    balances are created and existing ones locked exclusively by a single
+    statement, so two transactions never both hold a shared lock on a balance
+    that they then both need to upgrade.
+
+    Returns:
+      dict: product ID to current stock.
+    """
+    productids = {int(product) for product in products}
+    if not productids:
+      return {}
+    cursor.Execute("""
+        INSERT INTO `%s` (`product`, `amount`)
+        VALUES %s
+        ON DUPLICATE KEY UPDATE `amount` = `amount`""" % (
+            cls.TableName(), ', '.join(
+                '(%d, 0)' % productid for productid in sorted(productids))))
+    rows = cursor.Execute("""
+        SELECT `product`, `amount`
+        FROM `%s`
+        WHERE `product` in (%s)
+        ORDER BY `product`
+        FOR UPDATE""" % (cls.TableName(), _IdList(productids)))
+    return {int(row['product']): int(row['amount']) for row in rows}
+
+  @classmethod
+  def Rebuild(cls, connection):
+    """Discards all stored balances and re-derives them from the ledger
+    checkpoint and the newer ledger rows."""
+    with connection as cursor:
+      totals = Stockcheckpoint.Totals(cursor)
+      cursor.Execute('DELETE FROM `%s`' % cls.TableName())
+      cursor.Execute('DELETE FROM `%s`' % Possiblestock.TableName())
+      cursor.Execute("""
+          INSERT INTO `%s` (`product`, `amount`)
+          SELECT `product`, `amount`
+          FROM %s AS ledger""" % (cls.TableName(), totals))
+      Productversion.BumpAll(cursor)
+
+  @classmethod
+  def Verify(cls, connection):
+    """Compares the stored balances with the ledger.
+
+    Returns:
+      list: dicts with the product ID, the stored balance and the ledger total
+            for every product where the two disagree.
+    """
+    with connection as cursor:
+      mismatches = cursor.Execute("""
+          SELECT ledger.product, COALESCE(balance.amount, 0) AS stored,
+                 ledger.amount AS ledger
+          FROM %(totals)s AS ledger
+          LEFT JOIN `%(balance)s` AS balance
+            ON balance.product = ledger.product
+          WHERE COALESCE(balance.amount, 0) != ledger.amount
+          UNION ALL
+          SELECT balance.product, balance.amount AS stored, 0 AS ledger
+          FROM `%(balance)s` AS balance
+          WHERE balance.amount != 0
+            AND balance.product NOT IN (SELECT product
+                                        FROM %(totals)s AS ledger)""" % {
+              'totals': Stockcheckpoint.Totals(cursor),
+              'balance': cls.TableName()})
+    return [{'product': int(row['product']),
+             'stored': int(row['stored']),
+             'ledger': int(row['ledger'])} for row in mismatches]
+
+
+class Stockcheckpoint(model.Record):
+  """Provides a model abstraction for the stockcheckpoint table
+
+  The checkpoint holds the stock of every product, optionally per lot, summed
+  over the stock ledger up to and including the ledger row lastID. Ledger
+  totals are read from the checkpoint plus the newer ledger rows, so their cost
+  follows recent activity instead of the age of the warehouse. The ledger rows
+  that the checkpoint covers can be moved to the stock archive.
+  """
+  _PRIMARY_KEY = 'product', 'lot'
+
+  @classmethod
+  def LastID(cls, cursor):
+    """Returns the ID of the last ledger row covered by the checkpoint."""
+    rows = cursor.Execute(
+        'SELECT COALESCE(MAX(`lastID`), 0) AS lastID FROM `%s`' % cls.TableName())
+    return int(rows[0]['lastID'])
+
+  @classmethod
+  def Totals(cls, cursor):
+    """Returns the SQL for a derived table of the ledger total per product.
+
+    The total is the checkpoint plus the ledger rows after it, as of the last
+    checkpoint read on the given cursor.
+    """
+    return """(SELECT `product`, SUM(`amount`) AS amount
+               FROM (SELECT `product`, `amount` FROM `%s`
+                     UNION ALL
+                     SELECT `product`, `amount` FROM `%s` WHERE `ID` > %d)
+                    AS rows
+               GROUP BY `product`)""" % (
+        cls.TableName(), Stock.TableName(), cls.LastID(cursor))
+
+  @classmethod
+  def Advance(cls, connection, cutoff, lots=False, chunksize=1000):
+    """Moves the checkpoint up to the ledger rows created before the cutoff.
+
+    The ledger rows since the previous checkpoint are added to it, so writing a
+    checkpoint only reads the rows since the previous one.
+
+    Arguments:
+      @ connection: sqltalk.connection
+        Database connection to use.
+      @ cutoff: datetime.datetime
+        Ledger rows created before this moment are covered by the checkpoint.
+      % lots: bool ~~ False
+        Keep the checkpoint per lot, rather than per product only.
+      % chunksize: int ~~ 1000
+        Amount of checkpoint rows written per INSERT.
+
+    Returns:
+      int: the ID of the last ledger row that the checkpoint covers, or None
+           when there were no ledger rows to add.
+    """
+    with connection as cursor:
+      previous = cls.LastID(cursor)
+      lastid = cursor.Execute("""
+          SELECT MAX(`ID`) AS lastID
+          FROM `%s`
+          WHERE `ID` > %d AND `dateCreated` < '%s'""" % (
+              Stock.TableName(), previous, cutoff.isoformat(' ')))[0]['lastID']
+      if lastid is None:
+        return None
+      lot = "COALESCE(`lot`, '')" if lots else "''"
+      rows = cursor.Execute("""
+          SELECT `product`, `lot`, SUM(`amount`) AS amount
+          FROM (SELECT `product`, %(lot)s AS lot, `amount`
+                FROM `%(checkpoint)s`
+                UNION ALL
+                SELECT `product`, %(lot)s AS lot, `amount`
+                FROM `%(stock)s`
+                WHERE `ID` > %(previous)d AND `ID` <= %(lastid)d) AS ledger
+          GROUP BY `product`, `lot`""" % {
+              'lot': lot,
+              'checkpoint': cls.TableName(),
+              'stock': Stock.TableName(),
+              'previous': previous,
+              'lastid': int(lastid)})
+      values = [{'product': int(row['product']),
+                 'lot': row['lot'],
+                 'amount': int(row['amount']),
+                 'lastID': int(lastid),
+                 'cutoff': cutoff.isoformat(' ')} for row in rows]
+      cursor.Execute('DELETE FROM `%s`' % cls.TableName())
+      for start in range(0, len(values), chunksize):
+        cursor.Insert(table=cls.TableName(),
+                      values=values[start:start + chunksize])
+    return int(lastid)
+
+  @classmethod
+  def Archive(cls, connection, chunksize=10000):
+    """Moves the ledger rows covered by the checkpoint to the stock archive.
+
+    Rows are moved in chunks, each in a transaction of its own, so the ledger
+    is never locked for long.
+
+    Returns:
+      int: the amount of ledger rows moved.
+    """
+    with connection as cursor:
+      lastid = cls.LastID(cursor)
+    fields = '`ID`, `product`, `amount`, `reference`, `lot`, `dateCreated`'
+    moved = 0
+    while True:
+      with connection as cursor:
+        rows = cursor.Execute("""
+            SELECT `ID`, `product` FROM `%s`
+            WHERE `ID` <= %d
+            ORDER BY `ID`
+            LIMIT %d""" % (Stock.TableName(), lastid, chunksize))
+        if not rows:
+          return moved
+        upto = int(rows[-1]['ID'])
+        cursor.Execute("""
+            INSERT INTO `%s` (%s)
+            SELECT %s FROM `%s` WHERE `ID` <= %d""" % (
+                Stockarchive.TableName(), fields, fields, Stock.TableName(),
+                upto))
+        cursor.Execute('DELETE FROM `%s` WHERE `ID` <= %d' % (
+            Stock.TableName(), upto))
+        # The stock history shown for these products changed.
+        Productversion.Bump(cursor, {int(row['product']) for row in rows})
+      moved += len(rows)
+
+
+class Stockarchive(model.Record):
+  """Provides a model abstraction for the stockarchive table
+
+  The archive holds the stock ledger rows that were moved out of the stock
+  table after being covered by the checkpoint.
+  """
+
+
+class Possiblestock(model.Record):
+  """Provides a model abstraction for the possiblestock table
+
+  Caches the amount of assembled products that can be made from the available
+  parts. A stock mutation removes the cached values of every assembly that
+  uses the mutated product, directly or further up its bill of materials, in
+  the same transaction, so the cache is never stale.
+  """
+  _PRIMARY_KEY = 'product'
+
+  @classmethod
+  def ForProducts(cls, connection, products, store=True):
+    """Returns a dictionary of product ID to possible stock.
+
+    Cached values are used where present, the other products are resolved
+    together and cached.
+
+    Arguments:
+      % store: bool ~~ True
+        Whether to cache the resolved values. Reads on a replica resolve them
+        without writing, as the cache is written on the primary only.
+    """
+    productids = {int(product) for product in products}
+    if not productids:
+      return {}
+    with connection as cursor:
+      rows = cursor.Select(table=cls.TableName(),
+                           fields=('product', 'available'),
+                           conditions=['product in (%s)' % _IdList(productids)],
+                           escape=False)
+    possiblestock = {int(row['product']): int(row['available']) for row in rows}
+    missing = productids - set(possiblestock)
+    if missing:
+      possiblestock.update(cls._Resolve(connection, missing, store))
+    return possiblestock
+
+  @classmethod
+  def _Resolve(cls, connection, productids, store=True):
+    """Computes and caches the possible stock of the given products.
+
+    The stock balances involved are read with a shared lock. A concurrent stock
+    mutation of one of the parts waits until the computed values are cached,
+    and then removes them again. Values that are not stored are computed with
+    plain reads.
+    """
+    with connection as cursor:
+      resolver = BomResolver(connection, cursor)
+      try:
+        resolver.Load(productids, share=store)
+        possiblestock = {}
+        for productid in productids:
+          available = resolver.PossibleStock(productid)['available']
+          # Parts that are all used zero times do not limit the assembly.
+          possiblestock[productid] = 0 if available == math.inf else available
+      finally:
+        resolver.cursor = None
+      if not store:
+        return possiblestock
+      cursor.Execute("""
+          INSERT INTO `%s` (`product`, `available`)
+          VALUES %s
+          ON DUPLICATE KEY UPDATE `available` = VALUES(`available`)""" % (
+              cls.TableName(), ', '.join(
+                  '(%d, %d)' % (productid, available)
+                  for productid, available in sorted(possiblestock.items()))))
+    return possiblestock
+
+  @classmethod
+  def Invalidate(cls, cursor, products):
+    """Removes the cached possible stock of the given products."""
+    if products:
+      cursor.Execute('DELETE FROM `%s` WHERE `product` in (%s)' % (
+          cls.TableName(), _IdList(products)))
+
+
+class Productversion(model.Record):
+  """Provides a model abstraction for the productversion table
+
+  Every change to what the page or JSON of a product shows bumps its version,
+  in the transaction that makes the change: saving the product, changing its
+  bill of materials or one further down, and stock mutations of the product
+  or any of its parts. The catalog as a whole, which product pages list as
+  assembly options, has a version under product ID 0.
+  """
+  _PRIMARY_KEY = 'product'
+  CATALOG = 0
+
+  @classmethod
+  def Bump(cls, cursor, products):
+    """Increments the versions of the given products."""
+    if not products:
+      return
+    cursor.Execute("""
+        INSERT INTO `%s` (`product`, `version`, `dateModified`)
+        VALUES %s
+        ON DUPLICATE KEY UPDATE `version` = `version` + 1,
+                                `dateModified` = VALUES(`dateModified`)""" % (
+            cls.TableName(), ', '.join(
+                '(%d, 1, UTC_TIMESTAMP())' % product
+                for product in sorted({int(product) for product in products}))))
+
+  @classmethod
+  def BumpAll(cls, cursor):
+    """Increments the versions of all products, after a bulk rebuild."""
+    cursor.Execute("""
+        UPDATE `%s`
+        SET `version` = `version` + 1, `dateModified` = UTC_TIMESTAMP()""" % (
+            cls.TableName()))
+
+  @classmethod
+  def Catalog(cls, connection):
+    """Returns the version of the catalog as a whole."""
+    with connection as cursor:
+      rows = cursor.Select(table=cls.TableName(),
+                           fields=('version',),
+                           conditions=['product = %d' % cls.CATALOG],
+                           escape=False)
+    return int(rows[0]['version']) if rows else 0
+
+  @classmethod
+  def FromName(cls, connection, name):
+    """Returns the ID and version of the named product, and the catalog
+    version, without reading its stock or bill of materials.
+
+    Returns:
+      dict: the product ID, its version and dateModified, and the catalog
+            version and catalogModified. Products that were never changed
+            have version 0 and no dateModified.
+
+    Raises:
+      Product.NotExistError:
+        There is no product with this name.
+    """
+    with connection as cursor:
+      rows = cursor.Execute("""
+          SELECT product.ID,
+                 COALESCE(version.version, 0) AS version,
+                 version.dateModified,
+                 COALESCE(catalog.version, 0) AS catalog,
+                 catalog.dateModified AS catalogModified
+          FROM `%(product)s` AS product
+          LEFT JOIN `%(version)s` AS version ON version.product = product.ID
+          LEFT JOIN `%(version)s` AS catalog ON catalog.product = %(catalog)d
+          WHERE product.name = %(name)s
+            AND product.%(notdeleted)s""" % {
+              'product': Product.TableName(),
+              'version': cls.TableName(),
+              'catalog': cls.CATALOG,
+              'name': connection.EscapeValues(name),
+              'notdeleted': NOTDELETED})
+    if not rows:
+      raise Product.NotExistError(
+          'There is no product with common name %r' % name)
+    return dict(rows[0])
+
+
+class Productclosure(model.Record):
+  """Provides a model abstraction for the productclosure table
+
+  The closure holds a row for every product that is used further down the bill
+  of materials of an assembly, at any depth. The quantity is the amount of the
+  descendant needed for a single unit of the ancestor, summed over all paths
+  between the two, and paths is the amount of those paths. Adding or removing
+  a part adds or removes the paths through it, for all ancestors and
+  descendants at once.
+  """
+  _PRIMARY_KEY = 'ancestor', 'descendant'
+
+  @classmethod
+  def _Related(cls, cursor, product, field, other):
+    """Returns the products related to the given product, including itself,
+    with their quantity and amount of paths."""
+    productid = int(product)
+    rows = cursor.Select(table=cls.TableName(),
+                         fields=(field, 'quantity', 'paths'),
+                         conditions=['`%s` = %d' % (other, productid)],
+                         escape=False)
+    related = {int(row[field]): (int(row['quantity']), int(row['paths']))
+               for row in rows}
+    related[productid] = 1, 1
+    return related
+
+  @classmethod
+  def Link(cls, cursor, product, part, amount, sign=1):
+    """Adds, or with a negative sign removes, the paths through a part.
+
+    Arguments:
+      @ cursor: sqltalk.cursor
+        Cursor of the transaction that writes the part.
+      @ product: int
+        The assembly the part is used in.
+      @ part: int
+        The product used as part.
+      @ amount: int
+        The amount of the part used in a single assembly.
+      % sign: int ~~ 1
+        1 to add the part, -1 to remove it.
+    """
+    ancestors = cls._Related(cursor, product, 'ancestor', 'descendant')
+    descendants = cls._Related(cursor, part, 'descendant', 'ancestor')
+    values = []
+    for ancestor, (abovequantity, abovepaths) in sorted(ancestors.items()):
+      for descendant, (belowquantity, belowpaths) in sorted(descendants.items()):
+        values.append('(%d, %d, %d, %d)' % (
+            ancestor, descendant,
+            sign * abovequantity * int(amount) * belowquantity,
+            sign * abovepaths * belowpaths))
+    cursor.Execute("""
+        INSERT INTO `%s` (`ancestor`, `descendant`, `quantity`, `paths`)
+        VALUES %s
+        ON DUPLICATE KEY UPDATE `quantity` = `quantity` + VALUES(`quantity`),
+                                `paths` = `paths` + VALUES(`paths`)""" % (
+            cls.TableName(), ', '.join(values)))
+    if sign < 0:
+      cursor.Execute("""
+          DELETE FROM `%s`
+          WHERE `ancestor` in (%s) AND `paths` <= 0""" % (
+              cls.TableName(), _IdList(ancestors)))
+
+  @classmethod
+  def Contains(cls, cursor, product, part):
+    """Returns whether the product is the part, or is used anywhere down the
+    part's bill of materials, in which case adding the part would make the
+    product contain itself."""
+    if int(product) == int(part):
+      return True
+    return bool(cursor.Select(table=cls.TableName(),
+                              fields=('paths',),
+                              conditions=['ancestor = %d' % int(part),
+                                          'descendant = %d' % int(product)],
+                              escape=False))
+
+  @classmethod
+  def Ancestors(cls, cursor, products):
+    """Returns the IDs of all assemblies that use the given products, directly
+    or further up their bills of materials."""
+    if not products:
+      return set()
+    rows = cursor.Select(table=cls.TableName(),
+                         fields=('ancestor',),
+                         conditions=['descendant in (%s)' % _IdList(products)],
+                         escape=False)
+    return {int(row['ancestor']) for row in rows}
+
+  @classmethod
+  def Descendants(cls, cursor, products):
+    """Returns the IDs of all parts used by the given products, directly or
+    further down their bills of materials."""
+    if not products:
+      return set()
+    rows = cursor.Select(table=cls.TableName(),
+                         fields=('descendant',),
+                         conditions=['ancestor in (%s)' % _IdList(products)],
+                         escape=False)
+    return {int(row['descendant']) for row in rows}
+
+  @classmethod
+  def RawParts(cls, connection, product, amount=1):
+    """Returns the parts without parts of their own that are needed for the
+    given amount of the product, at any depth of its bill of materials.
+
+    Returns:
+      list: dicts with the part Product, the amount needed and its current
+            stock, by part name.
+    """
+    with connection as cursor:
+      rows = cursor.Execute("""
+          SELECT closure.quantity, part.*
+          FROM `%(closure)s` AS closure
+          JOIN `%(product)s` AS part ON part.ID = closure.descendant
+          WHERE closure.ancestor = %(ancestor)d
+            AND NOT EXISTS (SELECT 1 FROM `%(productpart)s` AS productpart
+                            WHERE productpart.product = closure.descendant)
+          ORDER BY part.name""" % {
+              'closure': cls.TableName(),
+              'product': Product.TableName(),
+              'productpart': Productpart.TableName(),
+              'ancestor': int(product)})
+    rows = [dict(row) for row in rows]
+    balances = Stockbalance.ForProducts(connection,
+                                        [int(row['ID']) for row in rows])
+    rawparts = []
+    for row in rows:
+      quantity = int(row.pop('quantity'))
+      rawparts.append({'part': Product(connection, row),
+                       'amount': quantity * amount,
+                       'currentstock': balances.get(int(row['ID']), 0)})
+    return rawparts
+
+  @classmethod
+  def Rebuild(cls, connection, chunksize=1000):
+    """Discards the closure and re-derives it from all bills of materials.
+
+    Returns:
+      list: the (product, part) pairs that were left out because they make a
+            product contain itself.
+    """
+    with connection as cursor:
+      rows = cursor.Select(table=Productpart.TableName(),
+                           fields=('product', 'part', 'amount'),
+                           conditions=['part IS NOT NULL'],
+                           escape=False)
+    children = collections.defaultdict(list)
+    for row in rows:
+      children[int(row['product'])].append((int(row['part']),
+                                            int(row['amount'])))
+    closure = {}
+    cycles = []
+
+    def Descendants(product, path):
+      if product not in closure:
+        path.add(product)
+        descendants = {}
+        for part, amount in children[product]:
+          if part in path:
+            cycles.append((product, part))
+            continue
+          below = dict(Descendants(part, path))
+          below[part] = 1, 1
+          for descendant, (quantity, paths) in below.items():
+            total = descendants.setdefault(descendant, [0, 0])
+            total[0] += amount * quantity
+            total[1] += paths
+        path.discard(product)
+        closure[product] = {descendant: tuple(total)
+                            for descendant, total in descendants.items()}
+      return closure[product]
+
+    values = []
+    for product in sorted(children):
+      for descendant, (quantity, paths) in sorted(
+          Descendants(product, set()).items()):
+        values.append({'ancestor': product, 'descendant': descendant,
+                       'quantity': quantity, 'paths': paths})
+    with connection as cursor:
+      cursor.Execute('DELETE FROM `%s`' % cls.TableName())
+      for start in range(0, len(values), chunksize):
+        cursor.Insert(table=cls.TableName(),
+                      values=values[start:start + chunksize])
+      cursor.Execute('DELETE FROM `%s`' % Possiblestock.TableName())
+      Productversion.BumpAll(cursor)
+    return cycles
 
 
 class Productpart(model.Record):
-  """Provides a model abstraction for the Productpart table"""
+  """Provides a model abstraction for the Productpart table
+
+  Every change to a bill of materials is applied to the product closure and
+  removes the affected possible stock from the cache, in the same transaction.
+  A part that would make a product contain itself is refused.
+  """
   _FOREIGN_RELATIONS = {'part': Product}
+  _stored = None
+
+  @classmethod
+  def WhereUsed(cls, cursor, products):
+    """Returns the IDs of all assemblies that use the given products, directly
+    or further up their bills of materials, in a single query."""
+    return Productclosure.Ancestors(cursor, products)
+
+  @classmethod
+  def CreateMany(cls, cursor, rows):
+    """Writes the given parts with a single multi-row INSERT.
+
+    Raises:
+      AssemblyError:
+        One of the parts would make a product contain itself.
+    """
+    if not rows:
+      return
+    for row in rows:
+      cls._Link(cursor, row['product'], row['part'], row['amount'])
+    cursor.Insert(table=cls.TableName(), values=rows)
+    cls._Invalidate(cursor, {int(row['product']) for row in rows},
+                    {int(row['part']) for row in rows})
+
+  @classmethod
+  def _Link(cls, cursor, product, part, amount, sign=1):
+    """Checks the part for cycles, then adds (or removes) it in the closure."""
+    if part is None:
+      return
+    if sign > 0 and Productclosure.Contains(cursor, product, part):
+      raise AssemblyError('Cannot use this part, it contains the product.')
+    Productclosure.Link(cursor, product, part, amount, sign)
+
+  @classmethod
+  def _Invalidate(cls, cursor, assemblies, parts):
+    """Removes the cached possible stock of the assemblies and everything that
+    uses them, as their bills of materials changed.
+
+    Their versions are bumped, and those of the parts, which list the
+    assemblies they are used in. The parts and everything further down their
+    bills of materials are bumped as well, their assembly options leave out
+    the products that use them, which just changed."""
+    assemblies = set(assemblies) | cls.WhereUsed(cursor, assemblies)
+    parts = {part for part in parts if part is not None}
+    Possiblestock.Invalidate(cursor, assemblies)
+    Productversion.Bump(cursor, assemblies | parts |
+                                Productclosure.Descendants(cursor, parts))
+
+  def _Edge(self):
+    """Returns the assembly, part and amount as stored in this record."""
+    part = dict.get(self, 'part')
+    return (int(dict.__getitem__(self, 'product')),
+            None if part is None else int(part),
+            int(self['amount']))
+
+  def _PreCreate(self, cursor):
+    super()._PreCreate(cursor)
+    self._Link(cursor, *self._Edge())
+
+  def _PostCreate(self, cursor):
+    super()._PostCreate(cursor)
+    product, part, _amount = self._Edge()
+    self._Invalidate(cursor, [product], [part])
+
+  def _PreSave(self, cursor):
+    """Replaces the paths of the stored part by those of the changed part."""
+    super()._PreSave(cursor)
+    stored = cursor.Select(table=self.TableName(),
+                           fields=('product', 'part', 'amount'),
+                           conditions=['ID = %d' % self.key],
+                           escape=False)
+    if stored:
+      stored = stored[0]
+      self._stored = (int(stored['product']),
+                      None if stored['part'] is None else int(stored['part']),
+                      int(stored['amount']))
+      self._Link(cursor, *self._stored, sign=-1)
+    self._Link(cursor, *self._Edge())
+
+  def _PostSave(self, cursor):
+    super()._PostSave(cursor)
+    edges = [self._Edge()]
+    if self._stored:
+      edges.append(self._stored)
+    self._Invalidate(cursor, [edge[0] for edge in edges],
+                     [edge[1] for edge in edges])
+
+  def Delete(self):
+    """Removes the part from the assembly, the closure and the affected
+    possible stock from the cache, in a single transaction."""
+    with self.connection as cursor:
+      product, part, amount = self._Edge()
+      self._Link(cursor, product, part, amount, sign=-1)
+      cursor.Execute('DELETE FROM `%s` WHERE `ID` = %d' % (
+          self.TableName(), self.key))
+      self._Invalidate(cursor, [product], [part])
 
   @property
   def subtotal(self):
@@ -251,7 +1581,7 @@ class Supplier(model.Record):
       *args, **kwargs)
 
   @classmethod
-  def Search(cls, connection, query=None, conditions=None, **kwargs):
+  def Search(cls, connection, query=None, order=None, conditions=None, **kwargs):
     """Returns the articles matching the search
 
       Arguments:
@@ -265,7 +1595,7 @@ class Supplier(model.Record):
     return cls.List(
       connection,
       conditions=['name like "%%%s%%"' % connection.EscapeValues(query)[1:-1]] + conditions,
-      order=[('ID', True)],
+      order=order or [('ID', True)],
       **kwargs)
 
   @classmethod
@@ -301,6 +1631,24 @@ class Supplier(model.Record):
         datetime.datetime.utcnow()))[0:19]
     self.Save()
 
+  @classmethod
+  def Create(cls, *args, **kwargs):
+    """Creates the supplier, and invalidates the cached listing counts and
+    rendered listings once committed."""
+    supplier = super().Create(*args, **kwargs)
+    cache.COUNTS.Invalidate(cls.TableName())
+    cache.PAGES.Invalidate()
+    return supplier
+
+  def Save(self, *args, **kwargs):
+    """Saves the supplier, and invalidates the cached listing counts and
+    rendered listings once committed, a save might have deleted this
+    supplier."""
+    result = super().Save(*args, **kwargs)
+    cache.COUNTS.Invalidate(self.TableName())
+    cache.PAGES.Invalidate()
+    return result
+
   def Products(self):
     """List products for this supplier"""
     return self.__children__(Products)
@@ -310,8 +1658,7 @@ class Supplier(model.Record):
     if self['gscode']:
       self['gscode'] = self['gscode'][:10]
     if self['name']:
-      self['name'] = re.search('([\w\-_\.,]+)',
-          self['name'].replace(' ', '_')).groups()[0][:45]
+      self['name'] = NormalizeName(self['name'], 45)
     if not self['name']:
       raise InvalidNameError('Provide a valid name')
 
@@ -320,14 +1667,66 @@ class Supplier(model.Record):
     if self['gscode']:
       self['gscode'] = self['gscode'][:10]
     if self['name']:
-      self['name'] = re.search('([\w\-_\.,]+)',
-          self['name'].replace(' ', '_')).groups()[0][:45]
+      self['name'] = NormalizeName(self['name'], 45)
     if not self['name']:
       raise InvalidNameError('Provide a valid name')
 
+  def _PostCreate(self, cursor):
+    super()._PostCreate(cursor)
+    Productversion.Bump(cursor, [Productversion.CATALOG])
+
+  def _PostSave(self, cursor):
+    """Bumps the catalog version, product pages show the supplier."""
+    super()._PostSave(cursor)
+    Productversion.Bump(cursor, [Productversion.CATALOG])
+
 
 class User(model.Record):
-  """Provides interaction to the user table"""
+  """Provides interaction to the user table
+
+  Users read for a session are cached for a short while, so a cache hit sends
+  no query. Saving or deleting a user removes it from the cache of this worker
+  as soon as the change is committed, other workers notice the change once
+  their cached entry expires, at most SESSIONTTL seconds later.
+  """
+  SESSIONTTL = 30
+  _sessions = cache.TTLCache(maxsize=1024, ttl=SESSIONTTL)
+
+  @classmethod
+  def FromSession(cls, connection, userid):
+    """Returns the user with the given ID, using the session cache.
+
+    Arguments:
+      @ connection: sqltalk.connection
+        Database connection to use.
+      @ userid: int
+        The ID of the user the session belongs to.
+
+    Raises:
+      NotExistError:
+        The given user does not exist.
+
+    Returns:
+      User: user abstraction class.
+    """
+    record = cls._sessions.Get(userid)
+    if record is None:
+      generation = cls._sessions.generation
+      record = dict(cls.FromPrimary(connection, userid))
+      cls._sessions.Set(userid, record, generation=generation)
+    return cls(connection, record)
+
+  def Save(self, *args, **kwargs):
+    """Saves the user, and drops it from the session cache once committed."""
+    result = super().Save(*args, **kwargs)
+    self._sessions.Invalidate(self.key)
+    return result
+
+  def Delete(self, *args, **kwargs):
+    """Deletes the user, and drops it from the session cache once committed."""
+    result = super().Delete(*args, **kwargs)
+    self._sessions.Invalidate(self.key)
+    return result
 
   @classmethod
   def FromEmail(cls, connection, email, conditions=None):
@@ -367,10 +1766,11 @@ class User(model.Record):
       # fake a login attempt, and slow down, even though we know its never going
       # to end in a valid login, we dont want to let anyone know the account
       # does or does not exist.
+      fakehash = passwords.POOL.Hash(password)
       if connection.debug:
-        print('password for non existant user would have been: ', pbkdf2_sha256.hash(password))
+        print('password for non existant user would have been: ', fakehash)
       raise cls.NotExistError('Invalid login, or inactive account.')
-    if pbkdf2_sha256.verify(password, user[0]['password']):
+    if passwords.POOL.Verify(password, user[0]['password']):
       return user[0]
     raise cls.NotExistError('Invalid password')
 
@@ -378,7 +1778,7 @@ class User(model.Record):
     """Hashes the password and stores it in the database"""
     if len(password) < 8:
       raise ValueError('password too short, 8 characters minimal.')
-    self['password'] = pbkdf2_sha256.hash(password)
+    self['password'] = passwords.POOL.Hash(password)
     self.Save()
 
   def _PreCreate(self, cursor):
@@ -393,9 +1793,7 @@ class User(model.Record):
 
   def PasswordResetHash(self):
     """Returns a hash based on the user's ID, name and password."""
-    return pbkdf2_sha256.hash('%d%s%s' % (
-         self['ID'], self['email'], self['password']),
-         salt=bytes(self['ID']))
+    return passwords.POOL.ResetHash(self['ID'], self['email'], self['password'])
 
 
 class Session(model.SecureCookie):
@@ -403,9 +1801,17 @@ class Session(model.SecureCookie):
 
 
 class Apiuser(model.Record):
-  """Provides a model abstraction for the apiuser table"""
+  """Provides a model abstraction for the apiuser table
+
+  Validated keys are cached for a short while, so a cache hit sends no query.
+  Saving or deleting a key removes it from the cache of this worker as soon as
+  the change is committed, other workers refuse it once their cached entry
+  expires, at most KEYTTL seconds later.
+  """
 
   KEYLENGTH = 32
+  KEYTTL = 10
+  _keys = cache.TTLCache(maxsize=256, ttl=KEYTTL)
 
   def _PreCreate(self, cursor):
     super()._PreCreate(cursor)
@@ -428,17 +1834,34 @@ class Apiuser(model.Record):
     if not self['name']:
       raise InvalidNameError('Provide a valid name')
 
+  def Save(self, *args, **kwargs):
+    """Saves the key, and drops it from the cache once committed."""
+    result = super().Save(*args, **kwargs)
+    self._keys.Invalidate(self['key'])
+    return result
+
+  def Delete(self, *args, **kwargs):
+    """Deletes the key, and drops it from the cache once committed."""
+    result = super().Delete(*args, **kwargs)
+    self._keys.Invalidate(self['key'])
+    return result
+
   @classmethod
   def FromKey(cls, connection, key):
     """Returns a user object by API key."""
     if not key:
       raise cls.NotExistError('No API key given.')
-    user = list(cls.List(connection,
-        conditions=('`key` = %s' % connection.EscapeValues(key),
-                    '`active` = "true"')))
-    if not user:
-      raise cls.NotExistError('Invalid key, or inactive key.')
-    return user[0]
+    record = cls._keys.Get(key)
+    if record is None:
+      generation = cls._keys.generation
+      user = list(cls.List(connection,
+          conditions=('`key` = %s' % connection.EscapeValues(key),
+                      '`active` = "true"')))
+      if not user:
+        raise cls.NotExistError('Invalid key, or inactive key.')
+      record = dict(user[0])
+      cls._keys.Set(key, record, generation=generation)
+    return cls(connection, record)
 
 
 class InvalidNameError(Exception):
@@ -2,17 +2,113 @@
 """Request handlers for the uWeb3 warehouse inventory software"""
 
 # standard modules
+import datetime
+import email.utils
+import hashlib
+import io
+import json
+import os
+import re
+import secrets
+import threading
 import time
 import locale
 import urllib.parse
+import weakref
 
 # uweb modules
 import uweb3
+from uweb3 import templateparser
 from uweb3.libs import mail
 
 # project modules
+from . import cache
+from . import export
+from . import importer
+from . import instrument
 from . import model
-from .helpers import PagedResult
+from . import passwords
+from . import pool
+from . import settings
+from .helpers import KeysetResult, PagedResult
+
+# Per worker state: the config file watcher, the parsers that have the static
+# tags and functions registered, the locale in use and the rendered page
+# fragments.
+CONFIG = settings.ConfigWatcher(
+    os.path.join(os.path.dirname(__file__), 'config.ini'))
+_PARSERS = weakref.WeakValueDictionary()
+_LOCALE = {'name': None, 'valid': False, 'version': None}
+_FRAGMENTS = cache.TTLCache(maxsize=512, ttl=3600)
+# The templates are parsed once per process, and shared by its threads.
+TEMPLATEDIR = os.path.join(os.path.dirname(__file__), 'templates')
+_TEMPLATES = {'parser': None, 'lock': threading.Lock(), 'modified': 0}
+
+
+def Templates():
+  """Returns the template parser shared by all requests of the process."""
+  if _TEMPLATES['parser'] is None:
+    with _TEMPLATES['lock']:
+      if _TEMPLATES['parser'] is None:
+        _TEMPLATES['parser'] = templateparser.Parser(TEMPLATEDIR)
+  return _TEMPLATES['parser']
+
+
+def Preload():
+  """Parses all templates, so workers forked afterwards share them."""
+  parser = Templates()
+  for path, _dirs, files in os.walk(TEMPLATEDIR):
+    for name in files:
+      location = os.path.join(path, name)
+      parser.AddTemplate(os.path.relpath(location, TEMPLATEDIR))
+      _TEMPLATES['modified'] = max(_TEMPLATES['modified'],
+                                   os.stat(location).st_mtime_ns)
+
+
+class RequestParser:
+  """The shared template parser, with the tags of a single request.
+
+  Tags registered during a request are passed along with its own Parse calls
+  only, so concurrent requests on other threads never see them.
+  """
+  def __init__(self, parser):
+    self._parser = parser
+    self.tags = {}
+
+  def RegisterTag(self, tag, value):
+    self.tags[tag] = value
+
+  def Parse(self, template, **replacements):
+    return self._parser.Parse(template, **dict(self.tags, **replacements))
+
+  def __getattr__(self, name):
+    return getattr(self._parser, name)
+
+
+def Currency(value):
+  """Formats the value as an amount of money in the configured locale."""
+  if _LOCALE['valid']:
+    return locale.currency(value, symbol=False, grouping=True)
+  return value
+
+
+def SetLocale(name, version):
+  """Switches the worker to the given locale, for the given config version.
+
+  Nothing is done when this config version was set up already, or when the
+  locale is in use already."""
+  if version == _LOCALE['version']:
+    return
+  _LOCALE['version'] = version
+  if name == _LOCALE['name']:
+    return
+  try:
+    locale.setlocale(locale.LC_ALL, name)
+    _LOCALE['valid'] = True
+  except locale.Error:
+    _LOCALE['valid'] = False
+  _LOCALE['name'] = name
+
 
 def apiuser(f):
   """Decorator to check if the given API key is allowed to access the resource."""
@@ -29,13 +125,49 @@ def apiuser(f):
     elif 'apikey' in args[0].req.headers:
       key = args[0].req.headers.get('apikey')
     try:
-      args[0].apikey = model.Apiuser.FromKey(args[0].connection, key)
+      args[0].apikey = model.Apiuser.FromKey(args[0].primary, key)
     except model.Apiuser.NotExistError as apierror:
       return uweb3.Response(content={'error': str(apierror)}, httpcode=403)
     return f(*args, **kwargs)
   return wrapper
 
 
+def readonly(f):
+  """Decorator that sends the queries of a handler to the read replica, when
+  the [mysql_replica] config section sets one up.
+
+  Only GET requests use the replica. Clients that changed something recently
+  carry a pin cookie and stay on the primary, so they read their own writes.
+  """
+  def wrapper(*args, **kwargs):
+    args[0].replica = args[0]._ReplicaAllowed()
+    return f(*args, **kwargs)
+  return wrapper
+
+
+def cachedpage(template):
+  """Decorator that renders the handler's output with the given template, like
+  uweb3's TemplateParser, and reuses the rendered page for later requests.
+
+  Pages are cached per handler and listing arguments, and for the version of
+  the catalog, so a change made through any worker makes them stale. The
+  parts that differ per user are rendered as placeholders, which are filled
+  in after the cache lookup. Handlers called with arguments, eg. to show a
+  message after a change, are always rendered.
+  """
+  def decorator(f):
+    def wrapper(*args, **kwargs):
+      pagemaker = args[0]
+      if len(args) > 1 or kwargs or pagemaker.debug:
+        output = f(*args, **kwargs)
+        if isinstance(output, dict):
+          return pagemaker.parser.Parse(template, **output)
+        return output
+      return pagemaker._CachedPage(f.__name__, template, f)
+    return wrapper
+  return decorator
+
+
 def NotExistsErrorCatcher(f):
   """Decorator to return a 404 if a NotExistError exception was returned."""
   def wrapper(*args, **kwargs):
@@ -46,34 +178,190 @@ def NotExistsErrorCatcher(f):
   return wrapper
 
 
+def PoolBusyCatcher(f):
+  """Decorator to return a 503 asking to try again if the password hashing
+  pool was too busy."""
+  def wrapper(*args, **kwargs):
+    try:
+      return f(*args, **kwargs)
+    except passwords.PoolBusyError:
+      return args[0].Error('The server is busy, please try again.', 503)
+  return wrapper
+
+
+@instrument.TagHandlers
 class PageMaker(uweb3.DebuggingPageMaker, uweb3.LoginMixin):
   """Holds all the request handlers for the application"""
 
   DEFAULTPAGESIZE = 10
+  # Cookie that keeps a client on the primary database after it wrote, and
+  # the default amount of seconds it does so.
+  PINCOOKIE = 'primary'
+  PINSECONDS = 10
+  replica = False
+  validators = None
+  # Listing arguments that rendered pages are cached for, and the tags that
+  # are filled in per request.
+  PAGEARGUMENTS = 'query', 'supplier', 'page', 'after', 'before'
+  PERUSERTAGS = 'header', 'footer', 'xsrf'
+  PLACEHOLDER = '__page_%s_%%s__' % secrets.token_hex(8)
+  # The most products looked up in a single bulk request.
+  BULKLIMIT = 500
+  # The most stock mutations shown on a product page, longer histories are
+  # available as an export.
+  STOCKVIEWLIMIT = 500
+
+  @property
+  def connection(self):
+    """Returns the database connection of this thread from the worker's pool,
+    with its queries instrumented.
+
+    Handlers marked readonly get a connection to the read replica. Options
+    missing from the [mysql_replica] section are taken from [mysql]."""
+    if self.replica:
+      return instrument.Instrument(pool.Get(
+          dict(self.options['mysql'], **self.options['mysql_replica']),
+          'mysql_replica'))
+    return self.primary
+
+  @property
+  def primary(self):
+    """Returns the connection to the primary database, also for handlers
+    marked readonly. Sessions and API keys are always checked on it, so a
+    deactivated user or key is refused as soon as the change is committed."""
+    return instrument.Instrument(pool.Get(self.options['mysql']))
+
+  def _ReplicaAllowed(self):
+    """Returns whether this request may read from the replica."""
+    return ('mysql_replica' in self.options and
+            self.req.method in ('GET', 'HEAD') and
+            not self.cookies.get(self.PINCOOKIE))
+
+  @property
+  def parser(self):
+    """Returns the template parser holding the tags of this request."""
+    if getattr(self, '_requestparser', None) is None:
+      self._requestparser = RequestParser(Templates())
+    return self._requestparser
 
   def _PostInit(self):
     """Sets up all the default vars"""
-    self.parser.RegisterTag('year', time.strftime('%Y'))
-    self.parser.RegisterFunction('ToID', lambda x: x.replace(' ', ''))
-    self.parser.RegisterFunction('NullString', lambda x: '' if x is None else x)
-    self.parser.RegisterFunction('DateOnly', lambda x: str(x)[0:10])
-    self.parser.RegisterFunction('TextareaRowCount', lambda x: len(str(x).split('\n')))
-    self.parser.RegisterTag('header', self.parser.JITTag(lambda: self.parser.Parse(
-                'parts/header.html')))
-    self.parser.RegisterTag('footer', self.parser.JITTag(lambda: self.parser.Parse(
-                'parts/footer.html', year=time.strftime('%Y'))))
+    instrument.Begin()
+    self._SetupParser()
+    self.parser.RegisterTag('header', self.parser.JITTag(
+        lambda: self._Fragment('header', 'parts/header.html')))
+    self.parser.RegisterTag('footer', self.parser.JITTag(
+        lambda: self._Fragment('footer', 'parts/footer.html')))
+    self.parser.RegisterTag('querystats', self.parser.JITTag(self._QueryStats))
     self.validatexsrf()
-    self.parser.RegisterTag('xsrf', self._Get_XSRF())
+    xsrf = self._Get_XSRF()
+    self.parser.RegisterTag('xsrf', xsrf)
     self.parser.RegisterTag('user', self.user)
+    self._fragmentkey = int(self.user) if self.user else None, xsrf
     self.pagesize = int(self.options['general'].get('pagesize', self.DEFAULTPAGESIZE))
 
+  def _SetupParser(self):
+    """Registers the static tags and functions, once for every parser."""
+    parser = Templates()
+    year = time.strftime('%Y')
+    if _PARSERS.get((id(parser), year)) is parser:
+      return
+    parser.RegisterTag('year', year)
+    parser.RegisterFunction('ToID', lambda x: x.replace(' ', ''))
+    parser.RegisterFunction('NullString', lambda x: '' if x is None else x)
+    parser.RegisterFunction('DateOnly', lambda x: str(x)[0:10])
+    parser.RegisterFunction('TextareaRowCount', lambda x: len(str(x).split('\n')))
+    parser.RegisterFunction('currency', Currency)
+    _PARSERS[id(parser), year] = parser
+
+  def _Fragment(self, name, template):
+    """Returns the rendered header or footer.
+
+    The header only depends on the user and the xsrf token, the footer only on
+    the year, so rendered fragments are reused between requests. In debug mode
+    templates are always rendered, so template changes show up directly."""
+    if name == 'footer':
+      key = name, time.strftime('%Y')
+    else:
+      key = (name,) + self._fragmentkey
+    fragment = None if self.debug else _FRAGMENTS.Get(key)
+    if fragment is None:
+      fragment = self.parser.Parse(template, year=time.strftime('%Y'))
+      _FRAGMENTS.Set(key, fragment)
+    return fragment
+
+  def _CachedPage(self, handler, template, f):
+    """Returns the page rendered by the handler, from the page cache when
+    present.
+
+    The page is cached per value of each listing argument, an argument that
+    is given empty is told apart from one that is absent."""
+    key = (model.Productversion.Catalog(self.connection),
+           tuple((argument in self.get, self.get.getfirst(argument, ''))
+                 for argument in self.PAGEARGUMENTS),
+           self.pagesize, self.options['general'].get('pagination'),
+           _LOCALE['name'], _TEMPLATES['modified'])
+    page = cache.PAGES.Get(handler, key)
+    if page is None:
+      generation = cache.PAGES.generation
+      output = f(self)
+      if not isinstance(output, dict):
+        return output
+      parser = RequestParser(Templates())
+      parser.tags.update(self.parser.tags)
+      for tag in self.PERUSERTAGS:
+        parser.RegisterTag(tag, self.PLACEHOLDER % tag)
+      page = parser.Parse(template, **output)
+      cache.PAGES.Set(handler, key, page, generation)
+    return self._Personalize(page)
+
+  def _Personalize(self, page):
+    """Fills in the per user tags of a cached page."""
+    values = {'header': lambda: self._Fragment('header', 'parts/header.html'),
+              'footer': lambda: self._Fragment('footer', 'parts/footer.html'),
+              'xsrf': self._Get_XSRF}
+    for tag in self.PERUSERTAGS:
+      placeholder = self.PLACEHOLDER % tag
+      if placeholder in page:
+        page = page.replace(placeholder, str(values[tag]()))
+    return page
+
+  def _QueryStats(self):
+    """Returns the query overview of the request so far, in debug mode."""
+    stats = instrument.Current()
+    if not self.debug or stats is None:
+      return ''
+    return self.parser.Parse('parts/querystats.html', stats=stats.Overview())
+
   def _PreRequest(self):
-    if self.config.Read():
-      try:
-        locale.setlocale( locale.LC_ALL, self.options['general'].get('locale', 'en_GB'))
-        self.parser.RegisterFunction('currency', lambda x: locale.currency(x, symbol=False, grouping=True))
-      except locale.Error:
-        self.parser.RegisterFunction('currency', lambda x: x)
+    """Reads the config when it changed on disk, and applies its locale."""
+    if CONFIG.Changed():
+      self.config.Read()
+      instrument.Configure(self.options.get('instrument', {}))
+    SetLocale(self.options['general'].get('locale', 'en_GB'), CONFIG.version)
+
+  def _PostRequest(self, response):
+    """Adds the query count and database time of the request as headers.
+
+    The connection of a failed request is closed rather than reused, as the
+    failure may have been a dropped connection. Requests that may have written
+    pin the client to the primary database for a while."""
+    if getattr(response, 'httpcode', 200) >= 500:
+      pool.Discard()
+    if ('mysql_replica' in self.options and
+        self.req.method not in ('GET', 'HEAD')):
+      self.req.AddCookie(self.PINCOOKIE, '1', path='/', httponly=True,
+                         max_age=int(self.options['mysql_replica'].get(
+                             'pinseconds', self.PINSECONDS)))
+    if (self.validators and isinstance(response, uweb3.Response) and
+        getattr(response, 'httpcode', 200) == 200):
+      for header, value in self.validators.items():
+        response.AddHeader(header, value)
+    stats = instrument.End()
+    if stats is not None and isinstance(response, uweb3.Response):
+      response.AddHeader('X-Query-Count', str(stats.queries))
+      response.AddHeader('Server-Timing', stats.ServerTiming())
+    return response
 
   @uweb3.decorators.TemplateParser('login.html')
   def RequestLogin(self, url=None):
@@ -115,8 +403,11 @@ class PageMaker(uweb3.DebuggingPageMaker, uweb3.LoginMixin):
     except model.User.NotExistError as error:
       self.parser.RegisterTag('loginerror', '%s' % error)
       print('login failed.', self.post.getfirst('email'))
+    except passwords.PoolBusyError:
+      self.parser.RegisterTag('loginerror', 'The server is busy, please try again.')
     return self.RequestLogin(url)
 
+  @PoolBusyCatcher
   @uweb3.decorators.checkxsrf
   def RequestResetPassword(self, email=None, resethash=None):
     """Handles the post for the reset password."""
@@ -175,11 +466,12 @@ class PageMaker(uweb3.DebuggingPageMaker, uweb3.LoginMixin):
       user = model.Session(self.connection)
     except Exception:
       raise ValueError('Session cookie invalid')
-    user = model.User.FromPrimary(self.connection, int(str(user)))
+    user = model.User.FromSession(self.primary, int(str(user)))
     if user['active'] != 'true':
       raise ValueError('User not active, session invalid')
     return user
 
+  @PoolBusyCatcher
   @uweb3.decorators.checkxsrf
   @uweb3.decorators.TemplateParser('setup.html')
   def RequestSetup(self):
@@ -213,6 +505,7 @@ class PageMaker(uweb3.DebuggingPageMaker, uweb3.LoginMixin):
       return {'error': 'Not all fields are properly filled out.'}
     return
 
+  @PoolBusyCatcher
   @uweb3.decorators.loggedin
   @uweb3.decorators.checkxsrf
   @uweb3.decorators.TemplateParser('admin.html')
@@ -298,6 +591,7 @@ class PageMaker(uweb3.DebuggingPageMaker, uweb3.LoginMixin):
               'users': users}
     return {'users': users}
 
+  @PoolBusyCatcher
   @uweb3.decorators.loggedin
   @uweb3.decorators.checkxsrf
   @uweb3.decorators.TemplateParser('usersettings.html')
@@ -325,6 +619,7 @@ class PageMaker(uweb3.DebuggingPageMaker, uweb3.LoginMixin):
             return self.Error('Mail could not be send due to server error, please contact support.')
       return {'succes': 'Password has been updated.'}
 
+  @PoolBusyCatcher
   @uweb3.decorators.loggedin
   @uweb3.decorators.checkxsrf
   @uweb3.decorators.TemplateParser('apisettings.html')
@@ -397,13 +692,40 @@ class PageMaker(uweb3.DebuggingPageMaker, uweb3.LoginMixin):
     return {'keys': keys}
 
 
+  def _PagedResult(self, modelcall, modelargs, prefetch=None):
+    """Returns a page of the model listing.
+
+    Keyset pagination is used when the request carries a page cursor, or when
+    the `pagination` option in the general config section is set to `keyset`.
+    Otherwise the listing is paged by page number, with the total count cached
+    for the current catalog version."""
+    if ('after' in self.get or 'before' in self.get or
+        self.options['general'].get('pagination') == 'keyset'):
+      return KeysetResult(self.pagesize,
+                          modelcall,
+                          self.connection,
+                          modelargs,
+                          after=self.get.getfirst('after', None),
+                          before=self.get.getfirst('before', None),
+                          prefetch=prefetch)
+    return PagedResult(self.pagesize,
+                       self.get.getfirst('page', 1),
+                       modelcall,
+                       self.connection,
+                       modelargs,
+                       prefetch=prefetch,
+                       counts=cache.COUNTS,
+                       countversion=model.Productversion.Catalog(
+                           self.connection))
+
   @uweb3.decorators.loggedin
   def RequestIndex(self):
     """Returns the homepage"""
     return self.RequestProducts()
 
+  @readonly
   @uweb3.decorators.loggedin
-  @uweb3.decorators.TemplateParser('products.html')
+  @cachedpage('products.html')
   def RequestProducts(self):
     """Returns the Products page"""
     supplier = None
@@ -418,22 +740,21 @@ class PageMaker(uweb3.DebuggingPageMaker, uweb3.LoginMixin):
       except model.User.NotExistError:
         pass
 
-    products_args = {'conditions': conditions,
-                     'order': [('ID', True)]}
+    products_args = {'conditions': conditions}
     query = ''
     if 'query' in self.get and self.get.getfirst('query', False):
+      # Search results are ranked on relevance, not ordered on ID.
       query = self.get.getfirst('query', '')
       linkarguments['query'] = query
       products_method = model.Product.Search
       products_args['query'] = query
     else:
       products_method = model.Product.List
+      products_args['order'] = [('ID', True)]
 
-    products = PagedResult(self.pagesize,
-                           self.get.getfirst('page', 1),
-                           products_method,
-                           self.connection,
-                           products_args)
+    products = self._PagedResult(products_method,
+                                 products_args,
+                                 prefetch=['supplier'])
     return {
         'supplier': supplier,
         'products': products,
@@ -441,28 +762,26 @@ class PageMaker(uweb3.DebuggingPageMaker, uweb3.LoginMixin):
         'query': query,
         'suppliers': list(model.Supplier.List(self.connection))}
 
+  @readonly
   @uweb3.decorators.loggedin
-  @uweb3.decorators.TemplateParser('gs1.html')
+  @cachedpage('gs1.html')
   def RequestGS1(self):
     """Returns the gs1 page"""
-    products = PagedResult(self.pagesize,
-                           self.get.getfirst('page', 1),
-                           model.Product.List,
-                           self.connection,
-                           {'conditions': ['gs1 is not null'],
-                            'order': [('gs1', False)]})
+    products = self._PagedResult(model.Product.List,
+                                 {'conditions': ['gs1 is not null'],
+                                  'order': [('gs1', False)]},
+                                 prefetch=['supplier'])
     return {'products': products}
 
+  @readonly
   @uweb3.decorators.loggedin
-  @uweb3.decorators.TemplateParser('ean.html')
+  @cachedpage('ean.html')
   def RequestEAN(self):
     """Returns the EAN page"""
-    products = PagedResult(self.pagesize,
-                           self.get.getfirst('page', 1),
-                           model.Product.List,
-                           self.connection,
-                           {'conditions': ['(gs1 is not null or ean is not null)'],
-                            'order': [('ean', False)]})
+    products = self._PagedResult(model.Product.List,
+                                 {'conditions': ['(gs1 is not null or ean is not null)'],
+                                  'order': [('ean', False)]},
+                                 prefetch=['supplier'])
     return {'products': products}
 
   @uweb3.decorators.loggedin
@@ -476,22 +795,40 @@ class PageMaker(uweb3.DebuggingPageMaker, uweb3.LoginMixin):
     product.Save()
     return self.RequestProducts()
 
+  @readonly
   @uweb3.decorators.loggedin
   @NotExistsErrorCatcher
   @uweb3.decorators.TemplateParser('product.html')
   def RequestProduct(self, name):
-    """Returns the product page"""
+    """Returns the product page, or 304 Not Modified when the client has the
+    current version of it.
+
+    Besides the product and catalog versions, the page depends on the user,
+    their xsrf token, the page size and locale, and the templates."""
+    version = model.Productversion.FromName(self.connection, name)
+    notmodified = self._Conditional(
+        hashlib.sha1(repr((
+            version['ID'], version['version'], version['catalog'],
+            int(self.user) if self.user else None, self._Get_XSRF(),
+            self.pagesize, _LOCALE['name'], _TEMPLATES['modified'])).encode(
+                'utf8')).hexdigest()[:24],
+        max(filter(None, (version['dateModified'],
+                          version['catalogModified'])), default=None),
+        private=True)
+    if notmodified:
+      return notmodified
     product = model.Product.FromName(self.connection, name)
+    model.BomResolver(self.connection).Load([product])
     parts = product.parts
-    if 'unlimitedstock' in self.get:
-      stock = list(product.Stock(order=[('dateCreated', True)]))
-      stockrows = False
-    else:
-      stock = list(product.Stock(limit=int(self.pagesize),
-                                 order=[('dateCreated', True)],
-                                 yield_unlimited_total_first=True))
-      stockrows = stock[0]
-      stock = stock[1:]
+    model.Prefetch(self.connection, [product] + [part['part'] for part in parts],
+                   'supplier', model.Supplier)
+    unlimitedstock = 'unlimitedstock' in self.get
+    stock = list(product.Stock(
+        limit=self.STOCKVIEWLIMIT if unlimitedstock else int(self.pagesize),
+        order=[('dateCreated', True)],
+        yield_unlimited_total_first=True))
+    stockrows = stock[0]
+    stock = stock[1:]
 
     partsprice = {'partstotal':0,
                   'assembly':0,
@@ -506,22 +843,101 @@ class PageMaker(uweb3.DebuggingPageMaker, uweb3.LoginMixin):
     return {'products': product.AssemblyOptions(),
             'parts': parts,
             'partsprice': partsprice,
+            'rawparts': product.RawParts() if parts else [],
             'product': product,
             'suppliers': model.Supplier.List(self.connection),
             'stock': stock,
-            'stockrows': stockrows}
+            'stockrows': stockrows,
+            'unlimitedstock': unlimitedstock,
+            'stockviewlimit': self.STOCKVIEWLIMIT}
 
+  @readonly
   @uweb3.decorators.ContentType('application/json')
   @apiuser
   def JsonProduct(self, name):
-    """Returns the product Json"""
+    """Returns the product Json, or 304 Not Modified when the client has the
+    current version of it."""
     try:
-     product = model.Product.FromName(self.connection, name)
+      version = model.Productversion.FromName(self.connection, name)
+      notmodified = self._Conditional(
+          'p%d-%d' % (version['ID'], version['version']),
+          version['dateModified'])
+      if notmodified:
+        return notmodified
+      product = model.Product.FromName(self.connection, name)
     except model.NotExistError as error:
-      return sef.RequestInvalidJsoncommand(error)
+      return self.RequestInvalidJsoncommand(error)
     return {'product': product,
             'currentstock': product.currentstock,
-            'possiblestock': product.possiblestock['available']}
+            'possiblestock': model.Possiblestock.ForProducts(
+                self.connection, [product], store=not self.replica)[product.key]}
+
+  @readonly
+  @uweb3.decorators.ContentType('application/json')
+  @apiuser
+  def JsonProducts(self):
+    """Returns the Json of many products at once, with their current and
+    possible stock.
+
+    Products are given by name, ID, EAN or SKU, as repeated `name`, `id`,
+    `ean` and `sku` query arguments, or as a posted JSON object holding lists
+    under `names`, `ids`, `eans` and `skus`. They are looked up with a single
+    query, after which their stock and possible stock are read for all of them
+    together. Identifiers that match no product are listed as missing, names,
+    EANs and SKUs match regardless of case, like they do in the database."""
+    try:
+      identifiers = self._BulkIdentifiers()
+    except ValueError as error:
+      return self.RequestInvalidJsoncommand(str(error), httpcode=400)
+    if sum(map(len, identifiers.values())) > self.BULKLIMIT:
+      return self.RequestInvalidJsoncommand(
+          'Look up at most %d products at once.' % self.BULKLIMIT, httpcode=400)
+    products = model.Product.FromIdentifiers(self.connection, **identifiers)
+    currentstock = model.Stockbalance.ForProducts(self.connection, products)
+    possiblestock = model.Possiblestock.ForProducts(
+        self.connection, products, store=not self.replica)
+    def Folded(kind, value):
+      return value if kind == 'ids' else str(value).casefold()
+    found = {kind: {Folded(kind, product[field]) for product in products
+                    if product[field] is not None}
+             for kind, field in (('names', 'name'), ('ids', 'ID'),
+                                 ('eans', 'ean'), ('skus', 'sku'))}
+    return {'products': [{'product': product,
+                          'currentstock': currentstock.get(product.key, 0),
+                          'possiblestock': possiblestock[product.key]}
+                         for product in products],
+            'missing': {kind: [value for value in values
+                               if Folded(kind, value) not in found[kind]]
+                        for kind, values in identifiers.items()}}
+
+  def _BulkIdentifiers(self):
+    """Returns the names, IDs, EANs and SKUs of a bulk lookup.
+
+    Raises:
+      ValueError:
+        The request holds invalid JSON or IDs.
+    """
+    kinds = {'names': 'name', 'ids': 'id', 'eans': 'ean', 'skus': 'sku'}
+    if self.req.method == 'POST':
+      try:
+        payload = self._JsonPayload('products')
+      except ValueError:
+        raise ValueError('The products should be valid JSON.')
+      if not isinstance(payload, dict):
+        raise ValueError('The products should be a JSON object.')
+      identifiers = {kind: payload.get(kind) or [] for kind in kinds}
+      if not all(isinstance(values, list) for values in identifiers.values()):
+        raise ValueError('The %s should be JSON arrays.' % ', '.join(kinds))
+    else:
+      identifiers = {kind: self.get.getlist(argument)
+                     for kind, argument in kinds.items()}
+    try:
+      identifiers['ids'] = [int(productid) for productid in identifiers['ids']]
+    except (TypeError, ValueError):
+      raise ValueError('The ids should be whole numbers.')
+    for kind in ('names', 'eans', 'skus'):
+      identifiers[kind] = [str(value) for value in identifiers[kind]]
+    return identifiers
 
   @uweb3.decorators.loggedin
   @uweb3.decorators.checkxsrf
@@ -568,6 +984,8 @@ class PageMaker(uweb3.DebuggingPageMaker, uweb3.LoginMixin):
                           error='Input error, some fields are wrong.')
     except self.connection.IntegrityError as error:
       return self.Error('That part was already assembled in this product!', 200)
+    except model.AssemblyError as error:
+      return self.Error(error, 200)
     return self.req.Redirect('/product/%s' % product['name'], httpcode=301)
 
   @uweb3.decorators.loggedin
@@ -590,7 +1008,10 @@ class PageMaker(uweb3.DebuggingPageMaker, uweb3.LoginMixin):
           if (key in updates and
               mateid in updates[key]):
             mate[key] = updates[key][mateid]
-        mate.Save()
+        try:
+          mate.Save()
+        except model.AssemblyError as error:
+          return self.Error(error, 200)
     return self.req.Redirect('/product/%s' % product['name'], httpcode=301)
 
   @uweb3.decorators.loggedin
@@ -628,6 +1049,80 @@ class PageMaker(uweb3.DebuggingPageMaker, uweb3.LoginMixin):
       return self.Error(error)
     return self.req.Redirect('/product/%s' % product['name'], httpcode=301)
 
+  def _Conditional(self, tag, modified=None, private=False):
+    """Sets the ETag and Last-Modified headers of the response, and returns a
+    304 Not Modified response when the client's copy is current.
+
+    Arguments:
+      @ tag: str
+        Identifies the exact content of the response.
+      % modified: datetime.datetime ~~ None
+        When the content last changed, in UTC.
+      % private: bool ~~ False
+        Whether the content is specific to the user.
+    """
+    etag = '"%s"' % tag
+    self.validators = {
+        'ETag': etag,
+        'Cache-Control': '%s, no-cache' % ('private' if private else 'public')}
+    if modified:
+      modified = modified.replace(tzinfo=datetime.timezone.utc, microsecond=0)
+      self.validators['Last-Modified'] = email.utils.format_datetime(
+          modified, usegmt=True)
+    nonematch = self.req.headers.get('if-none-match')
+    if nonematch is not None:
+      current = nonematch.strip() == '*' or etag in (
+          candidate.strip() for candidate in nonematch.split(','))
+    else:
+      try:
+        since = email.utils.parsedate_to_datetime(
+            self.req.headers.get('if-modified-since'))
+        if since.tzinfo is None:
+          since = since.replace(tzinfo=datetime.timezone.utc)
+      except (TypeError, ValueError):
+        since = None
+      current = bool(modified and since and modified <= since)
+    if current:
+      return uweb3.Response(content='', httpcode=304, headers=self.validators)
+    return None
+
+  @readonly
+  @uweb3.decorators.loggedin
+  @NotExistsErrorCatcher
+  def RequestProductStockExport(self, name, fileformat):
+    """Streams the stock history of a product as CSV or NDJSON."""
+    product = model.Product.FromName(self.connection, name)
+    return self._StockExport(fileformat, product['name'], product.key)
+
+  @readonly
+  @uweb3.decorators.loggedin
+  def RequestStockExport(self, fileformat):
+    """Streams the stock history of the whole warehouse as CSV or NDJSON."""
+    return self._StockExport(fileformat, 'warehouse')
+
+  def _StockExport(self, fileformat, name, product=None):
+    """Returns a streaming export of the stock ledger.
+
+    The ledger is filtered on the optional `from` and `until` dates and the
+    `lot` from the query arguments."""
+    try:
+      start, end = (
+          datetime.date.fromisoformat(self.get.getfirst(field))
+          if self.get.getfirst(field) else None
+          for field in ('from', 'until'))
+    except ValueError:
+      return self.Error('Dates should be given as YYYY-MM-DD.', 400)
+    rows = model.Stock.Export(self.connection,
+                              product=product,
+                              start=start,
+                              end=end,
+                              lot=self.get.getfirst('lot') or None)
+    filename = '%s-stock.%s' % (re.sub(r'[^\w.-]+', '_', name), fileformat)
+    return uweb3.Response(
+        content='',
+        content_type=export.Stream(rows, fileformat, model.Stock.EXPORTFIELDS),
+        headers={'Content-Disposition': 'attachment; filename="%s"' % filename})
+
   @uweb3.decorators.ContentType('application/json')
   @apiuser
   @NotExistsErrorCatcher
@@ -636,47 +1131,104 @@ class PageMaker(uweb3.DebuggingPageMaker, uweb3.LoginMixin):
 
     Send negative amount to Sell a product, positive amount to put product back
     into stock"""
-    try:
-      product = model.Product.FromName(self.connection, name)
-    except model.NotExistError as error:
-      return sef.RequestInvalidJsoncommand(error)
-    amount = int(self.post.getfirst('amount', -1))
-    currentstock = product.currentstock
-    if (amount < 0 and # only assemble when we sell
-        abs(amount) > currentstock): # only assemble when we have not enough stock
-      try:
-        product.Assemble(abs(amount) - currentstock, # only assemble what is missing for this sale
-                         'Assembly for %s' % self.post.getfirst('reference') if 'reference' in self.post else None)
-      except model.AssemblyError as error:
-        return self.RequestInvalidJsoncommand(error)
-    # by now we should have enough products in stock, one way or another
-    model.Stock.Create(self.connection,
-          {'product': product,
-           'amount': amount,
-           'reference': self.post.getfirst('reference', '')})
+    # A single line batch assembles what is missing for this sale and writes
+    # the sale in one transaction, with the stock of all products involved
+    # locked.
+    result = model.Stock.Batch(self.connection,
+        [{'product': name,
+          'amount': int(self.post.getfirst('amount', -1)),
+          'reference': self.post.getfirst('reference', '')}])[0]
+    if 'error' in result:
+      return self.RequestInvalidJsoncommand(result['error'])
     return True
 
+  @uweb3.decorators.ContentType('application/json')
+  @apiuser
+  def JsonStockBatch(self):
+    """Processes a batch of stock mutations, assembling products if needed.
+
+    Expects a JSON array of {product, amount, reference, lot} objects, either
+    as the request body or in the `lines` field. All lines are written in a
+    single transaction, and the result for every line is returned."""
+    try:
+      lines = self._JsonPayload('lines')
+    except ValueError:
+      return self.RequestInvalidJsoncommand('Lines should be valid JSON.', httpcode=400)
+    if not isinstance(lines, list):
+      return self.RequestInvalidJsoncommand('Lines should be a JSON array.', httpcode=400)
+    return {'lines': model.Stock.Batch(self.connection, lines)}
+
+  @uweb3.decorators.loggedin
+  @uweb3.decorators.checkxsrf
+  @uweb3.decorators.TemplateParser('import.html')
+  def RequestImport(self):
+    """Imports an uploaded file of products, parts and stock."""
+    if not self.post:
+      return {'formats': importer.FORMATS, 'report': None, 'error': None}
+    fileformat = self.post.getfirst('format', 'csv')
+    content = self.post.getfirst('importfile', '')
+    if isinstance(content, bytes):
+      content = content.decode('utf-8-sig', 'replace')
+    try:
+      report = importer.Importer(self.connection).Import(
+          importer.ReadRows(io.StringIO(content, newline=''), fileformat))
+    except ValueError as error:
+      return {'formats': importer.FORMATS, 'report': None, 'error': str(error)}
+    return {'formats': importer.FORMATS, 'report': report, 'error': None}
+
+  @uweb3.decorators.ContentType('application/json')
+  @apiuser
+  def JsonImport(self):
+    """Imports products, parts and stock.
+
+    Expects a JSON array of row objects, either as the request body or in the
+    `rows` field, or CSV text in the `csv` field. Returns the import report."""
+    try:
+      if 'csv' in self.post:
+        rows = importer.ReadRows(io.StringIO(self.post.getfirst('csv'),
+                                             newline=''), 'csv')
+      else:
+        rows = self._JsonPayload('rows')
+        if not isinstance(rows, list):
+          return self.RequestInvalidJsoncommand('Rows should be a JSON array.', httpcode=400)
+        rows = enumerate(rows, 1)
+      return importer.Importer(self.connection).Import(rows)
+    except ValueError as error:
+      return self.RequestInvalidJsoncommand(str(error), httpcode=400)
+
+  def _JsonPayload(self, field):
+    """Returns the JSON payload of a post request.
+
+    A JSON request body is used as is, for form posts the given field is
+    decoded."""
+    if isinstance(self.post, (list, dict)):
+      if isinstance(self.post, dict) and field in self.post:
+        return self.post[field]
+      return self.post
+    return json.loads(self.post.getfirst(field, 'null'))
+
+  @readonly
   @uweb3.decorators.loggedin
-  @uweb3.decorators.TemplateParser('suppliers.html')
+  @cachedpage('suppliers.html')
   def RequestSuppliers(self, error=None, success=None):
     """Returns the suppliers page"""
     suppliers = None
     query = ''
+    linkarguments = {}
     if 'query' in self.get and self.get.getfirst('query', False):
+      query = self.get.getfirst('query', '')
+      linkarguments['query'] = query
       suppliermethod = model.Supplier.Search
-      supplierarguments = {'query':  self.get.getfirst('query', ''),
+      supplierarguments = {'query': query,
                            'order': [('ID', True)]}
     else:
       suppliermethod = model.Supplier.List
       supplierarguments = {'order': [('ID', True)]}
 
-    suppliers = PagedResult(self.pagesize,
-                           self.get.getfirst('page', 1),
-                           suppliermethod,
-                           self.connection,
-                           supplierarguments)
+    suppliers = self._PagedResult(suppliermethod, supplierarguments)
     return {
         'suppliers': suppliers,
+        'linkarguments': urllib.parse.urlencode(linkarguments) or '',
         'query': query,
         'error': error,
         'success': success}
@@ -693,6 +1245,7 @@ class PageMaker(uweb3.DebuggingPageMaker, uweb3.LoginMixin):
     supplier.Save()
     return self.RequestSuppliers(success='Changes saved.')
 
+  @readonly
   @uweb3.decorators.loggedin
   @NotExistsErrorCatcher
   @uweb3.decorators.TemplateParser('supplier.html')
@@ -731,6 +1284,21 @@ class PageMaker(uweb3.DebuggingPageMaker, uweb3.LoginMixin):
     supplier.Delete()
     return self.req.Redirect('/suppliers', httpcode=301)
 
+  @uweb3.decorators.ContentType('text/plain; version=0.0.4')
+  def RequestMetrics(self):
+    """Returns the per handler query metrics of this worker.
+
+    Every worker keeps its own metrics, and a scrape is answered by whichever
+    worker takes the request. The `worker` label holds its process ID, so the
+    series of each worker stay apart and can be summed when queried.
+
+    Only the addresses listed in the [instrument] metrics option may read
+    them, by default only local ones."""
+    allowed = self.options.get('instrument', {}).get('metrics', '127.0.0.1 ::1')
+    if self.req.env.get('REMOTE_ADDR') not in allowed.split():
+      return uweb3.Response(content='Forbidden', httpcode=403)
+    return instrument.METRICS.Render() + cache.PAGES.Render()
+
   def XSRFInvalidToken(self):
     """Show that the users XSRF token is b0rked"""
     return self.Error("Your session has expired.", 403)
@@ -0,0 +1,143 @@
+#!/usr/bin/python3
+"""Password hashing and verification in a dedicated process pool.
+
+The key derivation is deliberately slow. Running it in a separate process
+keeps a burst of logins from stalling the other requests of a worker: the
+request thread waits on the result without holding the interpreter lock.
+"""
+
+# standard modules
+import concurrent.futures
+import concurrent.futures.process
+import multiprocessing
+import os
+import threading
+
+# Custom modules
+from passlib.hash import pbkdf2_sha256
+
+# Application
+from . import cache
+
+
+class PoolBusyError(Exception):
+  """The hashing pool has too much work queued, or took too long."""
+
+
+def _Hash(secret, salt=None):
+  """Returns the hash for the secret, runs in the pool's processes."""
+  if salt is None:
+    return pbkdf2_sha256.hash(secret)
+  return pbkdf2_sha256.hash(secret, salt=salt)
+
+
+def _Verify(secret, hashed):
+  """Returns whether the secret matches the hash, runs in the pool's
+  processes."""
+  return pbkdf2_sha256.verify(secret, hashed)
+
+
+class HashPool:
+  """A bounded pool of processes that hash and verify passwords."""
+  def __init__(self, workers=2, queuesize=16, timeout=10):
+    """Sets up the pool, processes are only started on first use.
+
+    Arguments:
+      % workers: int ~~ 2
+        Amount of hashing processes.
+      % queuesize: int ~~ 16
+        Maximum amount of hashes that are being computed or waiting.
+      % timeout: int ~~ 10
+        Seconds to wait for a place in the queue, and for the result.
+    """
+    self.workers = workers
+    self.timeout = timeout
+    self._slots = threading.BoundedSemaphore(queuesize)
+    self._lock = threading.Lock()
+    self._executor = None
+    self._pid = None
+    self._resethashes = cache.TTLCache(maxsize=1024, ttl=3600)
+
+  def _Executor(self):
+    """Returns the process pool of this worker, a forked worker starts its
+    own."""
+    with self._lock:
+      if self._executor is None or self._pid != os.getpid():
+        self._executor = concurrent.futures.ProcessPoolExecutor(
+            max_workers=self.workers,
+            mp_context=multiprocessing.get_context('forkserver'))
+        self._pid = os.getpid()
+      return self._executor
+
+  def _Drop(self, executor):
+    """Forgets a broken process pool, so the next operation starts a new one."""
+    with self._lock:
+      if self._executor is executor:
+        self._executor = None
+    executor.shutdown(wait=False)
+
+  def _Release(self, _future):
+    self._slots.release()
+
+  def _Run(self, function, *args):
+    """Runs the function in the pool and waits for its result.
+
+    When the pool broke, eg. because a hashing process was killed, it is
+    replaced and the function is run once more.
+
+    Raises:
+      PoolBusyError:
+        The queue stayed full, the result took longer than the timeout, or
+        the pool broke twice.
+    """
+    for attempt in range(2):
+      executor = self._Executor()
+      try:
+        return self._Wait(executor, function, *args)
+      except concurrent.futures.process.BrokenProcessPool:
+        self._Drop(executor)
+    raise PoolBusyError('The password processes stopped unexpectedly.')
+
+  def _Wait(self, executor, function, *args):
+    """Submits the function to the executor and waits for its result.
+
+    The queue slot is held until the function has finished, also when the
+    wait for it timed out.
+    """
+    if not self._slots.acquire(timeout=self.timeout):
+      raise PoolBusyError('Too many password operations are queued.')
+    try:
+      future = executor.submit(function, *args)
+    except BaseException:
+      self._slots.release()
+      raise
+    future.add_done_callback(self._Release)
+    try:
+      return future.result(timeout=self.timeout)
+    except concurrent.futures.TimeoutError:
+      raise PoolBusyError('Password operation timed out.')
+
+  def Hash(self, password):
+    """Returns a new salted hash for the password."""
+    return self._Run(_Hash, password)
+
+  def Verify(self, password, hashed):
+    """Returns whether the password matches the hash."""
+    return self._Run(_Verify, password, hashed)
+
+  def ResetHash(self, userid, email, passwordhash):
+    """Returns the password reset hash for a user.
+
+    The hash only changes with the user's email address or password, so it is
+    cached on those to spare clicks on a reset link the key derivation.
+    """
+    key = userid, email, passwordhash
+    resethash = self._resethashes.Get(key)
+    if resethash is None:
+      resethash = self._Run(_Hash, '%d%s%s' % (userid, email, passwordhash),
+                            bytes(userid))
+      self._resethashes.Set(key, resethash)
+    return resethash
+
+
+POOL = HashPool()
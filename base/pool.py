@@ -0,0 +1,216 @@
+#!/usr/bin/python3
+"""Per worker pool of database connections.
+
+Every thread that handles a request takes a connection from the pool of its
+worker process on first use, and hands it back when the response has been
+sent, streamed bodies included. Connections that were idle for a while are
+pinged before they are handed out, and replaced by a fresh connection when the
+server went away. The pools are emptied in forked children, so a worker never
+shares the sockets of the process it was forked from.
+
+There is a pool per config section, so the primary database and a read
+replica each have their own.
+"""
+
+# standard modules
+import os
+import threading
+import time
+
+# uweb modules
+from uweb3.libs.sqltalk import mysql
+
+# Idle connections kept per worker, and seconds of idleness after which a
+# connection is pinged before use.
+POOLSIZE = 8
+PINGAFTER = 10
+
+
+def Connect(options, database=None):
+  """Returns a new database connection based on the [mysql] config section.
+
+  Arguments:
+    @ options: dict
+      The [mysql] config section, holding the host, user, password, database
+      and charset.
+    % database: str ~~ None
+      Database to use instead of the configured one.
+  """
+  return mysql.Connect(host=options.get('host', 'localhost'),
+                       user=options.get('user'),
+                       passwd=options.get('password'),
+                       db=database or options.get('database'),
+                       charset=options.get('charset', 'utf8'))
+
+
+class ConnectionPool:
+  """Hands out a database connection per thread, reusing idle connections."""
+  def __init__(self, options):
+    """Sets up the pool, connections are made when they are first needed.
+
+    Arguments:
+      @ options: dict
+        The [mysql] config section.
+        % poolsize: str ~~ 8
+          The most idle connections kept.
+        % pingafter: str ~~ 10
+          Seconds of idleness after which a connection is pinged before use.
+    """
+    self.options = options
+    self.size = int(options.get('poolsize', POOLSIZE))
+    self.pingafter = float(options.get('pingafter', PINGAFTER))
+    self._idle = []
+    self._lock = threading.Lock()
+    self._local = threading.local()
+
+  def Get(self):
+    """Returns the connection of the current thread, taking one from the pool
+    when the thread does not hold one yet."""
+    connection = getattr(self._local, 'connection', None)
+    if connection is None:
+      connection = self._Take()
+      self._local.connection = connection
+    return connection
+
+  def _Take(self):
+    """Returns a healthy idle connection, or a new one."""
+    while True:
+      with self._lock:
+        if not self._idle:
+          break
+        connection, released = self._idle.pop()
+      if time.monotonic() - released < self.pingafter or self._Alive(connection):
+        return connection
+      self._Close(connection)
+    return Connect(self.options)
+
+  def Release(self):
+    """Hands the connection of the current thread back to the pool."""
+    connection = getattr(self._local, 'connection', None)
+    if connection is None:
+      return
+    self._local.connection = None
+    with self._lock:
+      if len(self._idle) < self.size:
+        self._idle.append((connection, time.monotonic()))
+        return
+    self._Close(connection)
+
+  def Discard(self):
+    """Closes the connection of the current thread instead of reusing it, eg.
+    after the server dropped it."""
+    connection = getattr(self._local, 'connection', None)
+    self._local.connection = None
+    if connection is not None:
+      self._Close(connection)
+
+  def Reset(self):
+    """Forgets all connections without closing them, for use in a forked
+    child, where the sockets still belong to the parent."""
+    self._idle = []
+    self._lock = threading.Lock()
+    self._local = threading.local()
+
+  @staticmethod
+  def _Alive(connection):
+    """Returns whether the server still answers on the connection."""
+    try:
+      if hasattr(connection, 'ping'):
+        connection.ping(False)
+      else:
+        with connection as cursor:
+          cursor.Execute('SELECT 1')
+    except Exception:
+      return False
+    return True
+
+  @staticmethod
+  def _Close(connection):
+    try:
+      connection.close()
+    except Exception:
+      pass
+
+
+_POOLS = {}
+_LOCK = {'lock': threading.Lock()}
+
+
+def Get(options, name='mysql'):
+  """Returns the connection of the current thread from the worker's pool.
+
+  Arguments:
+    @ options: dict
+      The config section to set up the pool with, on first use.
+    % name: str ~~ 'mysql'
+      Name of the pool, the config section it was set up from.
+  """
+  if name not in _POOLS:
+    with _LOCK['lock']:
+      if name not in _POOLS:
+        _POOLS[name] = ConnectionPool(options)
+  return _POOLS[name].Get()
+
+
+def Setup(options, name='mysql'):
+  """Sets up the named pool from the given options, replacing the config
+  section it would otherwise be set up from, eg. to point the application at
+  the benchmark database.
+
+  Arguments:
+    @ options: dict
+      The config section to set up the pool with.
+    % name: str ~~ 'mysql'
+      Name of the pool.
+  """
+  with _LOCK['lock']:
+    _POOLS[name] = ConnectionPool(options)
+
+
+def Release():
+  """Hands the connections of the current thread back to their pools."""
+  for connectionpool in list(_POOLS.values()):
+    connectionpool.Release()
+
+
+def Discard():
+  """Closes the connections of the current thread."""
+  for connectionpool in list(_POOLS.values()):
+    connectionpool.Discard()
+
+
+def _AfterFork():
+  _LOCK['lock'] = threading.Lock()
+  for connectionpool in _POOLS.values():
+    connectionpool.Reset()
+
+
+os.register_at_fork(after_in_child=_AfterFork)
+
+
+class _Released:
+  """A response body that releases the thread's connection once it is sent."""
+  def __init__(self, body):
+    self.body = body
+
+  def __iter__(self):
+    return iter(self.body)
+
+  def close(self):
+    try:
+      if hasattr(self.body, 'close'):
+        self.body.close()
+    finally:
+      Release()
+
+
+class PoolMixin:
+  """Returns the database connection of a request to the pool after its
+  response, including streamed bodies, has been sent."""
+  def __call__(self, environ, start_response):
+    try:
+      body = super().__call__(environ, start_response)
+    except Exception:
+      Discard()
+      raise
+    return _Released(body)
@@ -0,0 +1,58 @@
+#!/usr/bin/python3
+"""Change detection for the warehouse config file."""
+
+# standard modules
+import os
+import threading
+import time
+
+
+class ConfigWatcher:
+  """Tracks whether the config file of a worker needs to be read again.
+
+  The file is stat-ed at most once per interval, and is considered changed
+  when its inode, modification time or size differ from the last read. Every
+  change increments the version, which caches that depend on the config can
+  key on. Sending SIGHUP to the gunicorn master restarts the workers, which
+  then read the config afresh.
+  """
+  def __init__(self, path, interval=1):
+    """Sets up the watcher.
+
+    Arguments:
+      @ path: str
+        Location of the config file.
+      % interval: int ~~ 1
+        Minimal amount of seconds between two checks of the file.
+    """
+    self.path = path
+    self.interval = interval
+    self.version = 0
+    self._signature = None
+    self._checked = None
+    self._lock = threading.Lock()
+
+  def _Signature(self):
+    """Returns the inode, modification time and size of the config file."""
+    try:
+      stat = os.stat(self.path)
+    except OSError:
+      return None
+    return stat.st_ino, stat.st_mtime_ns, stat.st_size
+
+  def Changed(self):
+    """Returns True when the config file changed since it was last read.
+
+    The first call always returns True, so the config is read once per worker.
+    """
+    now = time.monotonic()
+    with self._lock:
+      if self._checked is not None and now - self._checked < self.interval:
+        return False
+      self._checked = now
+      signature = self._Signature()
+      if self.version and signature == self._signature:
+        return False
+      self._signature = signature
+      self.version += 1
+      return True
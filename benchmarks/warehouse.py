@@ -0,0 +1,352 @@
+#!/usr/bin/python3
+"""Benchmarks the warehouse hot paths against a synthetic warehouse.
+
+A synthetic catalog, bill of materials tree and stock ledger is written to a
+separate MySQL/MariaDB database, after which the model operations behind the
+product pages, and the stock API handlers themselves, are timed. The handlers
+are called through the WSGI application, with an API key, the way the web
+server calls them. The results, including the amount of queries per
+operation, are written as JSON.
+
+Run from the project root:
+
+  python3 -m benchmarks.warehouse --database warehouse_benchmark
+"""
+
+# standard modules
+import argparse
+import collections
+import configparser
+import io
+import json
+import os
+import random
+import re
+import statistics
+import sys
+import time
+import urllib.parse
+import wsgiref.util
+
+# Application
+import base
+import manage
+from base import helpers
+from base import instrument
+from base import model
+from base import pool
+
+SCHEMA = os.path.join(os.path.dirname(__file__), '..', 'schema', 'schema.sql')
+CHUNKSIZE = 1000
+WORDS = ('bolt', 'nut', 'washer', 'bracket', 'hinge', 'panel', 'frame',
+         'spring', 'gasket', 'cable', 'housing', 'lid', 'jar', 'label',
+         'sticker', 'box', 'sleeve', 'cap', 'valve', 'clamp')
+
+
+def CreateSchema(connection):
+  """(Re)creates all warehouse tables from schema/schema.sql."""
+  with open(SCHEMA) as schema:
+    statements = schema.read().split(';\n')
+  with connection as cursor:
+    for statement in statements:
+      lines = [line for line in statement.splitlines()
+               if not line.startswith('--')]
+      statement = '\n'.join(lines).strip()
+      # The trailing statements restore session variables of a mysqldump run.
+      if statement and '@OLD_' not in statement:
+        cursor.Execute(statement)
+
+
+def Populate(connection, args):
+  """Writes the synthetic warehouse.
+
+  Products are split in raw parts and assemblies. Assemblies are spread over
+  the levels of the BOM, and use parts from the level below them (so the tree
+  reaches the requested depth), plus random parts from any lower level, which
+  makes sub-assemblies shared between assemblies.
+
+  Returns:
+    dict: the product IDs of the raw parts, the assemblies per level and the
+          top level assemblies.
+  """
+  rng = random.Random(args.seed)
+  with connection as cursor:
+    cursor.Insert(table=model.Supplier.TableName(), values=[
+        {'ID': supplier, 'name': 'supplier_%03d' % supplier,
+         'gscode': str(8700000 + supplier)}
+        for supplier in range(1, args.suppliers + 1)])
+
+  productids = list(range(1, args.products + 1))
+  for start in range(0, len(productids), CHUNKSIZE):
+    with connection as cursor:
+      cursor.Insert(table=model.Product.TableName(), values=[
+          {'ID': productid,
+           'name': 'product_%07d' % productid,
+           'ean': '%013d' % (1000000000000 + productid) if productid % 3 == 0 else None,
+           'gs1': productid if productid < 65536 and productid % 2 == 0 else None,
+           'sku': 'SKU%07d' % productid,
+           'description': ' '.join(rng.choice(WORDS) for _ in range(8)),
+           'supplier': rng.randint(1, args.suppliers),
+           'cost': round(rng.uniform(0.1, 99), 3)}
+          for productid in productids[start:start + CHUNKSIZE]])
+
+  assemblycount = int(args.products * args.assemblies)
+  raw = productids[:args.products - assemblycount]
+  assemblies = productids[args.products - assemblycount:]
+  levels = [raw]
+  perlevel = max(1, len(assemblies) // args.depth)
+  for level in range(args.depth):
+    levels.append(assemblies[level * perlevel:(level + 1) * perlevel]
+                  if level < args.depth - 1 else assemblies[level * perlevel:])
+  parts = []
+  for depth, level in enumerate(levels[1:], 1):
+    lower = [product for below in levels[:depth] for product in below]
+    for product in level:
+      chosen = {rng.choice(levels[depth - 1])}
+      while len(chosen) < min(args.fanout, len(lower)):
+        chosen.add(rng.choice(lower))
+      parts.extend({'product': product, 'part': part,
+                    'amount': rng.randint(1, 3)} for part in sorted(chosen))
+  for start in range(0, len(parts), CHUNKSIZE):
+    with connection as cursor:
+      cursor.Insert(table=model.Productpart.TableName(),
+                    values=parts[start:start + CHUNKSIZE])
+  model.Productclosure.Rebuild(connection)
+
+  for start in range(0, args.ledger, CHUNKSIZE):
+    with connection as cursor:
+      cursor.Insert(table=model.Stock.TableName(), values=[
+          {'product': rng.choice(raw),
+           'amount': rng.randint(-5, 50),
+           'reference': 'invoice %d' % row,
+           'lot': 'lot %d' % (row // 100)}
+          for row in range(start, min(start + CHUNKSIZE, args.ledger))])
+  model.Stockbalance.Rebuild(connection)
+  return {'raw': raw, 'levels': levels[1:], 'top': levels[-1]}
+
+
+class Client:
+  """Sends requests straight to the WSGI application, authenticated with an
+  API key."""
+  def __init__(self, app, apikey):
+    self.app = app
+    self.apikey = apikey
+
+  def Request(self, method, path, form=None):
+    """Handles the request, returns its time, database time and query count.
+
+    The database time and query count are read from the Server-Timing and
+    X-Query-Count headers of the response.
+
+    Raises:
+      RuntimeError:
+        The application did not answer with a 2xx status.
+    """
+    body = urllib.parse.urlencode(form or {}).encode('utf8')
+    environ = {}
+    wsgiref.util.setup_testing_defaults(environ)
+    environ.update({
+        'REQUEST_METHOD': method,
+        'PATH_INFO': path,
+        'QUERY_STRING': urllib.parse.urlencode({'apikey': self.apikey}),
+        'CONTENT_TYPE': 'application/x-www-form-urlencoded',
+        'CONTENT_LENGTH': str(len(body)),
+        'REMOTE_ADDR': '127.0.0.1',
+        # Keeps reads on the benchmark database, not a configured replica.
+        'HTTP_COOKIE': '%s=1' % base.pages.PageMaker.PINCOOKIE,
+        'wsgi.input': io.BytesIO(body)})
+    response = {}
+    def StartResponse(status, headers, exc_info=None):
+      response['status'] = status
+      response['headers'] = {name.lower(): value for name, value in headers}
+    start = time.perf_counter()
+    content = self.app(environ, StartResponse)
+    try:
+      for _chunk in content:
+        pass
+    finally:
+      if hasattr(content, 'close'):
+        content.close()
+    elapsed = time.perf_counter() - start
+    if not response['status'].startswith('2'):
+      raise RuntimeError('%s %s: %s' % (method, path, response['status']))
+    timing = re.search(r'db;dur=([\d.]+)',
+                       response['headers'].get('server-timing', ''))
+    return (elapsed,
+            float(timing.group(1)) / 1000 if timing else 0,
+            int(response['headers'].get('x-query-count', 0)))
+
+
+def ModelCall(name, function):
+  """Returns an operation that times the model function under the given name,
+  counting the queries it sends."""
+  def Operation(run):
+    instrument.Begin(name)
+    function(run)
+    stats = instrument.End(record=False)
+    return stats.elapsed, stats.dbtime, stats.queries
+  return Operation
+
+
+def Measure(operation, runs):
+  """Runs the operation repeatedly and returns its timings and query counts.
+
+  The operation returns the seconds it took, the seconds spent on queries and
+  the amount of queries, for each run."""
+  timings = []
+  dbtimes = []
+  queries = []
+  for run in range(runs):
+    elapsed, dbtime, count = operation(run)
+    timings.append(elapsed * 1000)
+    dbtimes.append(dbtime * 1000)
+    queries.append(count)
+  timings.sort()
+  return {'runs': runs,
+          'mean_ms': round(statistics.mean(timings), 3),
+          'median_ms': round(statistics.median(timings), 3),
+          'p95_ms': round(timings[min(runs - 1, int(runs * 0.95))], 3),
+          'max_ms': round(timings[-1], 3),
+          'db_mean_ms': round(statistics.mean(dbtimes), 3),
+          'queries_mean': round(statistics.mean(queries), 2),
+          'queries_max': max(queries)}
+
+
+def Benchmark(connection, client, warehouse, args):
+  """Times the hot paths, returns a dict of results per operation."""
+  rng = random.Random(args.seed)
+  instrument.Instrument(connection)
+  raw = [model.Product.FromPrimary(connection, rng.choice(warehouse['raw']))
+         for _ in range(args.runs)]
+  top = [model.Product.FromPrimary(connection, rng.choice(warehouse['top']))
+         for _ in range(args.runs)]
+  lastpage = max(1, args.products // 10)
+
+  def CurrentStock(run):
+    return raw[run].currentstock
+
+  def PossibleStock(run):
+    return model.Product(connection, dict(top[run])).possiblestock
+
+  def Assemble(run):
+    product = model.Product(connection, dict(top[run]))
+    try:
+      product.Assemble(1, 'benchmark')
+    except model.AssemblyError:
+      pass
+
+  def FirstPage(run):
+    return helpers.PagedResult(10, 1, model.Product.List, connection,
+                               {'order': [('ID', True)]})
+
+  def DeepPage(run):
+    return helpers.PagedResult(10, lastpage, model.Product.List, connection,
+                               {'order': [('ID', True)]})
+
+  def Search(run):
+    return list(model.Product.Search(connection, query=rng.choice(WORDS),
+                                     limit=10))
+
+  def JsonProduct(run):
+    return client.Request(
+        'GET', '/api/v1/product/%s' % urllib.parse.quote(top[run]['name']))
+
+  def JsonProductStock(run):
+    return client.Request(
+        'POST', '/api/v1/product/%s/stock' % urllib.parse.quote(
+            raw[run]['name']),
+        {'amount': -1, 'reference': 'benchmark'})
+
+  operations = {
+      'Product.currentstock': ModelCall('Product.currentstock', CurrentStock),
+      'Product.possiblestock': ModelCall('Product.possiblestock', PossibleStock),
+      'Product.Assemble': ModelCall('Product.Assemble', Assemble),
+      'PagedResult first page': ModelCall('PagedResult first page', FirstPage),
+      'PagedResult deep page': ModelCall('PagedResult deep page', DeepPage),
+      'Product.Search': ModelCall('Product.Search', Search),
+  }
+  results = {name: Measure(operation, args.runs)
+             for name, operation in operations.items()}
+  Restock(connection, raw)
+  results['JsonProduct'] = Measure(JsonProduct, args.runs)
+  results['JsonProductStock'] = Measure(JsonProductStock, args.runs)
+  return results
+
+
+def Restock(connection, products):
+  """Puts a unit in stock for every time a product is listed, so selling them
+  one by one through the stock API never needs an assembly.
+
+  Raises:
+    RuntimeError:
+      A stock line was refused.
+  """
+  sales = collections.Counter(product['name'] for product in products)
+  for result in model.Stock.Batch(connection, [
+      {'product': name, 'amount': amount, 'reference': 'benchmark restock'}
+      for name, amount in sorted(sales.items())]):
+    if 'error' in result:
+      raise RuntimeError('Restocking %s failed: %s' % (
+          result['product'], result['error']))
+
+
+def Application(connection, config, database):
+  """Returns a client for the WSGI application, with the application reading
+  from and writing to the given database, and an API key it accepts."""
+  app = base.main()
+  pool.Setup(dict(config['mysql'], database=database))
+  apikey = model.Apiuser.Create(connection, {'name': 'benchmark'})['key']
+  return Client(app, apikey)
+
+
+def main():
+  parser = argparse.ArgumentParser(description=__doc__,
+      formatter_class=argparse.RawDescriptionHelpFormatter)
+  parser.add_argument('--config', default=manage.CONFIG,
+                      help='config file holding the [mysql] section')
+  parser.add_argument('--database', required=True,
+                      help='database to (re)create the synthetic warehouse in')
+  parser.add_argument('--products', type=int, default=10000,
+                      help='catalog size')
+  parser.add_argument('--assemblies', type=float, default=0.1,
+                      help='fraction of the catalog that is assembled')
+  parser.add_argument('--depth', type=int, default=3, help='BOM depth')
+  parser.add_argument('--fanout', type=int, default=4,
+                      help='parts per assembly')
+  parser.add_argument('--suppliers', type=int, default=50)
+  parser.add_argument('--ledger', type=int, default=100000,
+                      help='amount of stock ledger rows')
+  parser.add_argument('--runs', type=int, default=50,
+                      help='runs per operation')
+  parser.add_argument('--seed', type=int, default=1)
+  parser.add_argument('--output', help='file to write the results to')
+  args = parser.parse_args()
+
+  config = configparser.ConfigParser()
+  config.read(args.config)
+  if args.database == config['mysql'].get('database'):
+    parser.error('refusing to overwrite the configured warehouse database')
+  args.suppliers = min(args.suppliers, 255)
+
+  connection = manage.Connect(args.config, args.database)
+  start = time.perf_counter()
+  CreateSchema(connection)
+  warehouse = Populate(connection, args)
+  populated = time.perf_counter() - start
+  client = Application(connection, config, args.database)
+  results = {
+      'parameters': {key: value for key, value in vars(args).items()
+                     if key not in ('config', 'output')},
+      'populate_seconds': round(populated, 3),
+      'operations': Benchmark(connection, client, warehouse, args)}
+  output = json.dumps(results, indent=2)
+  if args.output:
+    with open(args.output, 'w') as outfile:
+      outfile.write(output + '\n')
+  else:
+    print(output)
+  return 0
+
+
+if __name__ == '__main__':
+  sys.exit(main())
@@ -0,0 +1,36 @@
+"""Gunicorn settings for running the warehouse in production.
+
+Start with `gunicorn3 -c gunicorn.conf.py`, or run `gunicorn.sh`. The amount
+of worker processes and threads per worker are read from the [gunicorn]
+section of base/config.ini:
+
+  [gunicorn]
+  bind = :8001
+  workers = 4
+  threads = 4
+  timeout = 30
+
+Workers default to twice the amount of cores plus one, with a single thread
+each. The application and its templates are loaded once, before the workers
+are forked. Every worker keeps its own pool of database connections, sized by
+the `poolsize` option of the [mysql] section.
+"""
+
+# standard modules
+import configparser
+import multiprocessing
+import os
+
+_CONFIG = configparser.ConfigParser()
+_CONFIG.read(os.path.join(os.path.dirname(__file__), 'base', 'config.ini'))
+_OPTIONS = _CONFIG['gunicorn'] if _CONFIG.has_section('gunicorn') else {}
+
+chdir = os.path.dirname(os.path.abspath(__file__))
+wsgi_app = 'base:main()'
+bind = _OPTIONS.get('bind', ':8001')
+workers = int(_OPTIONS.get('workers', multiprocessing.cpu_count() * 2 + 1))
+threads = int(_OPTIONS.get('threads', 1))
+timeout = int(_OPTIONS.get('timeout', 30))
+max_requests = int(_OPTIONS.get('max_requests', 0))
+max_requests_jitter = max_requests // 10
+preload_app = True
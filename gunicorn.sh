@@ -1,2 +1,2 @@
 #/bin/bash
-gunicorn3 'base:main()' --workers=1 -b :8001
+gunicorn3 -c "$(dirname "$0")/gunicorn.conf.py"
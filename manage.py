@@ -0,0 +1,141 @@
+#!/usr/bin/python3
+"""Maintenance commands for the warehouse.
+
+Run `./manage.py --help` for a list of the available commands.
+"""
+
+# standard modules
+import argparse
+import configparser
+import datetime
+import os
+import sys
+
+# Application
+from base import importer
+from base import model
+from base import pool
+
+CONFIG = os.path.join(os.path.dirname(__file__), 'base', 'config.ini')
+
+
+def Connect(configfile=CONFIG, database=None):
+  """Returns a database connection based on the [mysql] config section.
+
+  The database name from the config is used unless another one is given.
+  """
+  config = configparser.ConfigParser()
+  config.read(configfile)
+  return pool.Connect(config['mysql'], database)
+
+
+def Balance(connection, args):
+  """Rebuilds or verifies the stock balances against the stock ledger."""
+  if args.action == 'rebuild':
+    model.Stockbalance.Rebuild(connection)
+    print('Stock balances rebuilt from the ledger.')
+  mismatches = model.Stockbalance.Verify(connection)
+  for mismatch in mismatches:
+    print('product %(product)d: balance %(stored)d, ledger %(ledger)d' % mismatch)
+  if mismatches:
+    print('%d stock balances do not match the ledger.' % len(mismatches))
+    return 1
+  print('All stock balances match the ledger.')
+  return 0
+
+
+def Checkpoint(connection, args):
+  """Moves the stock ledger checkpoint forward, and optionally archives the
+  ledger rows it covers."""
+  if args.before:
+    cutoff = datetime.datetime.combine(args.before, datetime.time())
+  else:
+    cutoff = datetime.datetime.combine(
+        datetime.date.today() - datetime.timedelta(days=args.days),
+        datetime.time())
+  lastid = model.Stockcheckpoint.Advance(connection, cutoff, lots=args.lots)
+  if lastid is None:
+    print('No new stock mutations before %s.' % cutoff)
+  else:
+    print('Checkpoint moved to stock mutation %d, before %s.' % (lastid, cutoff))
+  if args.archive:
+    print('Archived %d stock mutations.' %
+          model.Stockcheckpoint.Archive(connection))
+  return 0
+
+
+def Closure(connection, args):
+  """Rebuilds the product closure from the bills of materials."""
+  cycles = model.Productclosure.Rebuild(connection)
+  for product, part in cycles:
+    print('product %d: part %d makes it contain itself, left out.' % (
+        product, part))
+  print('Product closure rebuilt from the bills of materials.')
+  return 1 if cycles else 0
+
+
+def Import(connection, args):
+  """Imports products, bills of materials and stock from a file."""
+  fileformat = args.format or os.path.splitext(args.file)[1][1:].lower()
+  if fileformat not in importer.FORMATS:
+    print('Unknown import format %r, use --format.' % fileformat)
+    return 2
+  with open(args.file, newline='', encoding='utf-8-sig') as stream:
+    report = importer.Importer(connection, args.chunksize).Import(
+        importer.ReadRows(stream, fileformat))
+  for error in report['errors']:
+    print('line %(line)d: %(error)s' % error)
+  print('Imported %(product)d products, %(part)d parts and %(stock)d stock '
+        'mutations.' % report['created'])
+  if report['errorcount']:
+    print('%d rows could not be imported.' % report['errorcount'])
+    return 1
+  return 0
+
+
+def main():
+  parser = argparse.ArgumentParser(description=__doc__)
+  parser.add_argument('--config', default=CONFIG,
+                      help='config file holding the [mysql] section')
+  commands = parser.add_subparsers(dest='command', required=True)
+
+  balance = commands.add_parser(
+      'balance', help='rebuild or verify the stored stock balances')
+  balance.add_argument('action', choices=('rebuild', 'verify'))
+  balance.set_defaults(handler=Balance)
+
+  checkpoint = commands.add_parser(
+      'checkpoint', help='checkpoint and optionally archive the stock ledger')
+  checkpoint.add_argument('--before', type=datetime.date.fromisoformat,
+                          help='cover the ledger before this date (YYYY-MM-DD)')
+  checkpoint.add_argument('--days', type=int, default=90,
+                          help='without --before, cover the ledger older than '
+                               'this many days')
+  checkpoint.add_argument('--lots', action='store_true',
+                          help='keep the checkpoint per lot')
+  checkpoint.add_argument('--archive', action='store_true',
+                          help='move the covered ledger rows to the archive')
+  checkpoint.set_defaults(handler=Checkpoint)
+
+  closure = commands.add_parser(
+      'closure', help='rebuild the closure of the bills of materials')
+  closure.add_argument('action', choices=('rebuild',))
+  closure.set_defaults(handler=Closure)
+
+  imports = commands.add_parser(
+      'import', help='import products, parts and stock from a file',
+      description=importer.__doc__,
+      formatter_class=argparse.RawDescriptionHelpFormatter)
+  imports.add_argument('file', help='CSV, JSON or NDJSON file to import')
+  imports.add_argument('--format', choices=importer.FORMATS,
+                       help='file format, by default taken from the extension')
+  imports.add_argument('--chunksize', type=int, default=importer.CHUNKSIZE,
+                       help='rows written per transaction')
+  imports.set_defaults(handler=Import)
+
+  args = parser.parse_args()
+  return args.handler(Connect(args.config), args)
+
+
+if __name__ == '__main__':
+  sys.exit(main())
@@ -14,6 +14,20 @@ CREATE TABLE `apiuser` (
 ) ENGINE=InnoDB AUTO_INCREMENT=1 DEFAULT CHARSET=utf8;
 /*!40101 SET character_set_client = @saved_cs_client */;
 
+--
+-- Table structure for table `possiblestock`
+--
+
+DROP TABLE IF EXISTS `possiblestock`;
+/*!40101 SET @saved_cs_client     = @@character_set_client */;
+/*!40101 SET character_set_client = utf8 */;
+CREATE TABLE `possiblestock` (
+  `product` mediumint(8) unsigned NOT NULL,
+  `available` int(11) NOT NULL DEFAULT '0',
+  PRIMARY KEY (`product`)
+) ENGINE=InnoDB DEFAULT CHARSET=utf8;
+/*!40101 SET character_set_client = @saved_cs_client */;
+
 --
 -- Table structure for table `product`
 --
@@ -43,6 +57,23 @@ CREATE TABLE `product` (
 ) ENGINE=InnoDB AUTO_INCREMENT=1 DEFAULT CHARSET=utf8;
 /*!40101 SET character_set_client = @saved_cs_client */;
 
+--
+-- Table structure for table `productclosure`
+--
+
+DROP TABLE IF EXISTS `productclosure`;
+/*!40101 SET @saved_cs_client     = @@character_set_client */;
+/*!40101 SET character_set_client = utf8 */;
+CREATE TABLE `productclosure` (
+  `ancestor` mediumint(8) unsigned NOT NULL,
+  `descendant` mediumint(8) unsigned NOT NULL,
+  `quantity` bigint(20) NOT NULL DEFAULT '0',
+  `paths` bigint(20) NOT NULL DEFAULT '0',
+  PRIMARY KEY (`ancestor`,`descendant`),
+  KEY `descendant` (`descendant`,`ancestor`)
+) ENGINE=InnoDB DEFAULT CHARSET=utf8;
+/*!40101 SET character_set_client = @saved_cs_client */;
+
 --
 -- Table structure for table `productpart`
 --
@@ -64,6 +95,21 @@ CREATE TABLE `productpart` (
 ) ENGINE=InnoDB AUTO_INCREMENT=1 DEFAULT CHARSET=utf8;
 /*!40101 SET character_set_client = @saved_cs_client */;
 
+--
+-- Table structure for table `productversion`
+--
+
+DROP TABLE IF EXISTS `productversion`;
+/*!40101 SET @saved_cs_client     = @@character_set_client */;
+/*!40101 SET character_set_client = utf8 */;
+CREATE TABLE `productversion` (
+  `product` mediumint(8) unsigned NOT NULL,
+  `version` int(10) unsigned NOT NULL DEFAULT '0',
+  `dateModified` datetime NOT NULL DEFAULT CURRENT_TIMESTAMP,
+  PRIMARY KEY (`product`)
+) ENGINE=InnoDB DEFAULT CHARSET=utf8;
+/*!40101 SET character_set_client = @saved_cs_client */;
+
 --
 -- Table structure for table `stock`
 --
@@ -78,10 +124,61 @@ CREATE TABLE `stock` (
   `reference` varchar(45) DEFAULT NULL,
   `lot` varchar(45) DEFAULT NULL,
   `dateCreated` datetime DEFAULT CURRENT_TIMESTAMP,
-  PRIMARY KEY (`ID`)
+  PRIMARY KEY (`ID`),
+  KEY `product` (`product`,`dateCreated`)
 ) ENGINE=InnoDB AUTO_INCREMENT=1 DEFAULT CHARSET=utf8;
 /*!40101 SET character_set_client = @saved_cs_client */;
 
+--
+-- Table structure for table `stockarchive`
+--
+
+DROP TABLE IF EXISTS `stockarchive`;
+/*!40101 SET @saved_cs_client     = @@character_set_client */;
+/*!40101 SET character_set_client = utf8 */;
+CREATE TABLE `stockarchive` (
+  `ID` mediumint(8) unsigned NOT NULL,
+  `product` mediumint(8) unsigned NOT NULL,
+  `amount` mediumint(9) NOT NULL,
+  `reference` varchar(45) DEFAULT NULL,
+  `lot` varchar(45) DEFAULT NULL,
+  `dateCreated` datetime DEFAULT CURRENT_TIMESTAMP,
+  PRIMARY KEY (`ID`),
+  KEY `product` (`product`,`dateCreated`)
+) ENGINE=InnoDB DEFAULT CHARSET=utf8;
+/*!40101 SET character_set_client = @saved_cs_client */;
+
+--
+-- Table structure for table `stockbalance`
+--
+
+DROP TABLE IF EXISTS `stockbalance`;
+/*!40101 SET @saved_cs_client     = @@character_set_client */;
+/*!40101 SET character_set_client = utf8 */;
+CREATE TABLE `stockbalance` (
+  `product` mediumint(8) unsigned NOT NULL,
+  `amount` int(11) NOT NULL DEFAULT '0',
+  PRIMARY KEY (`product`)
+) ENGINE=InnoDB DEFAULT CHARSET=utf8;
+/*!40101 SET character_set_client = @saved_cs_client */;
+
+--
+-- Table structure for table `stockcheckpoint`
+--
+
+DROP TABLE IF EXISTS `stockcheckpoint`;
+/*!40101 SET @saved_cs_client     = @@character_set_client */;
+/*!40101 SET character_set_client = utf8 */;
+CREATE TABLE `stockcheckpoint` (
+  `product` mediumint(8) unsigned NOT NULL,
+  `lot` varchar(45) NOT NULL DEFAULT '',
+  `amount` int(11) NOT NULL DEFAULT '0',
+  `lastID` mediumint(8) unsigned NOT NULL,
+  `cutoff` datetime NOT NULL,
+  PRIMARY KEY (`product`,`lot`)
+) ENGINE=InnoDB DEFAULT CHARSET=utf8;
+/*!40101 SET character_set_client = @saved_cs_client */;
+
 --
 -- Table structure for table `supplier`
 --
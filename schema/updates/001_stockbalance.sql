@@ -0,0 +1,11 @@
+-- Adds the materialized per product stock balance and indexes the stock ledger
+-- on product. Run `./manage.py balance rebuild` afterwards to fill the
+-- balances from the existing ledger.
+
+ALTER TABLE `stock` ADD KEY `product` (`product`,`dateCreated`);
+
+CREATE TABLE IF NOT EXISTS `stockbalance` (
+  `product` mediumint(8) unsigned NOT NULL,
+  `amount` int(11) NOT NULL DEFAULT '0',
+  PRIMARY KEY (`product`)
+) ENGINE=InnoDB DEFAULT CHARSET=utf8;
@@ -0,0 +1,7 @@
+-- Adds the full text index used by the product search. The ngram parser
+-- requires MySQL 5.7 or later and is not available on MariaDB, so the index is
+-- not part of schema.sql. Without it the search falls back to filtering on
+-- product name.
+
+ALTER TABLE `product`
+  ADD FULLTEXT KEY `search` (`name`,`sku`,`ean`,`description`) WITH PARSER ngram;
@@ -0,0 +1,22 @@
+-- Adds the stock ledger checkpoint and archive. Nothing needs to run
+-- afterwards, `./manage.py checkpoint` writes the first checkpoint.
+
+CREATE TABLE IF NOT EXISTS `stockarchive` (
+  `ID` mediumint(8) unsigned NOT NULL,
+  `product` mediumint(8) unsigned NOT NULL,
+  `amount` mediumint(9) NOT NULL,
+  `reference` varchar(45) DEFAULT NULL,
+  `lot` varchar(45) DEFAULT NULL,
+  `dateCreated` datetime DEFAULT CURRENT_TIMESTAMP,
+  PRIMARY KEY (`ID`),
+  KEY `product` (`product`,`dateCreated`)
+) ENGINE=InnoDB DEFAULT CHARSET=utf8;
+
+CREATE TABLE IF NOT EXISTS `stockcheckpoint` (
+  `product` mediumint(8) unsigned NOT NULL,
+  `lot` varchar(45) NOT NULL DEFAULT '',
+  `amount` int(11) NOT NULL DEFAULT '0',
+  `lastID` mediumint(8) unsigned NOT NULL,
+  `cutoff` datetime NOT NULL,
+  PRIMARY KEY (`product`,`lot`)
+) ENGINE=InnoDB DEFAULT CHARSET=utf8;
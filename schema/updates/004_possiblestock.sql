@@ -0,0 +1,8 @@
+-- Adds the possible stock cache. It fills itself as products are requested,
+-- nothing needs to run afterwards.
+
+CREATE TABLE IF NOT EXISTS `possiblestock` (
+  `product` mediumint(8) unsigned NOT NULL,
+  `available` int(11) NOT NULL DEFAULT '0',
+  PRIMARY KEY (`product`)
+) ENGINE=InnoDB DEFAULT CHARSET=utf8;
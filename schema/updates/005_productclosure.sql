@@ -0,0 +1,12 @@
+-- Adds the product closure, holding every product used at any depth of the
+-- bill of materials of an assembly. Run `./manage.py closure rebuild`
+-- afterwards to fill it from the existing bills of materials.
+
+CREATE TABLE IF NOT EXISTS `productclosure` (
+  `ancestor` mediumint(8) unsigned NOT NULL,
+  `descendant` mediumint(8) unsigned NOT NULL,
+  `quantity` bigint(20) NOT NULL DEFAULT '0',
+  `paths` bigint(20) NOT NULL DEFAULT '0',
+  PRIMARY KEY (`ancestor`,`descendant`),
+  KEY `descendant` (`descendant`,`ancestor`)
+) ENGINE=InnoDB DEFAULT CHARSET=utf8;
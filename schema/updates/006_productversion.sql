@@ -0,0 +1,15 @@
+-- Adds the product versions behind the ETag and Last-Modified headers of the
+-- product pages and JSON. Every product, and the catalog as product 0, starts
+-- at version 1, nothing needs to run afterwards.
+
+CREATE TABLE IF NOT EXISTS `productversion` (
+  `product` mediumint(8) unsigned NOT NULL,
+  `version` int(10) unsigned NOT NULL DEFAULT '0',
+  `dateModified` datetime NOT NULL DEFAULT CURRENT_TIMESTAMP,
+  PRIMARY KEY (`product`)
+) ENGINE=InnoDB DEFAULT CHARSET=utf8;
+
+INSERT IGNORE INTO `productversion` (`product`, `version`, `dateModified`)
+SELECT 0, 1, UTC_TIMESTAMP()
+UNION ALL
+SELECT `ID`, 1, UTC_TIMESTAMP() FROM `product`;